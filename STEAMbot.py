@@ -1,19 +1,146 @@
 import os
 import time
-import requests
+import httpx
 from datetime import datetime
 import json
+import random
+import hashlib
+import html
+import heapq
+import inspect
+import contextlib
 import asyncio
+import atexit
+import bisect
 import signal
+import logging
+import logging.handlers
+import queue
 import sys
 import re
+import sqlite3
+from collections import OrderedDict
+from html.parser import HTMLParser
 from pathlib import Path
+from types import MappingProxyType
+from urllib.parse import urlparse
 
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
-from telegram.error import TelegramError, BadRequest
+from telegram.ext import Application, BaseUpdateProcessor, CommandHandler, ContextTypes, CallbackQueryHandler
+from telegram.error import TelegramError, BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from dotenv import load_dotenv
 
+# =============================================================================
+# ЛОГИРОВАНИЕ
+# =============================================================================
+
+# Стандартные поля LogRecord - всё остальное пришло через extra и попадает в JSON
+_RECORD_FIELDS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна JSON-строка: удобно для сборщиков логов"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and key != 'sample':
+                entry[key] = value
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает каждую N-ю запись с extra={'sample': ключ}, начиная с первой.
+
+    Нужен для однотипных ошибок на горячем пути (например, ошибки отправки в рассылке):
+    при массовом сбое они не забивают лог и очередь, а количество пропущенных
+    записей сохраняется в поле sampled.
+    """
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self.seen = {}
+
+    def filter(self, record):
+        key = getattr(record, 'sample', None)
+        if key is None:
+            return True
+        count = self.seen.get(key, 0)
+        self.seen[key] = count + 1
+        if count % self.every:
+            return False
+        record.sampled = self.every if count else 1
+        return True
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который не форматирует запись целиком в вызывающем потоке.
+
+    Стандартный prepare() склеивает сообщение с traceback по формату обработчика,
+    из-за чего JSON-форматтер уже не видит исключение отдельно. Здесь подставляются
+    только аргументы сообщения и текст traceback, остальное делает поток вывода.
+    """
+
+    def prepare(self, record):
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+_log_listener = None
+
+
+def setup_logging(level, fmt='text', sample_every=100):
+    """Настраивает неблокирующий вывод логов.
+
+    Вызовы log.* из event loop только кладут запись в очередь (QueueHandler),
+    а форматирование и запись в stdout выполняет отдельный поток QueueListener -
+    медленный терминал или пайп не тормозят рассылку и обработку обновлений.
+    """
+    global _log_listener
+    stop_logging()
+    log_queue = queue.SimpleQueue()
+    queue_handler = LogQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_every))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    if fmt == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+    # httpx пишет INFO на каждый запрос - для нас это шум
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+
+    _log_listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток вывода"""
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+        _log_listener = None
+
+
+log = logging.getLogger('steambot')
+
 # ====================================================
 # КОНФИГУРАЦИЯ
 # ====================================================
@@ -22,6 +149,12 @@ from dotenv import load_dotenv
 env_path = Path(__file__).parent / '.env'
 load_dotenv(dotenv_path=env_path)
 
+# Логирование: уровень, формат (text или json) и частота выборки однотипных ошибок
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+LOG_SAMPLE_EVERY = int(os.getenv("LOG_SAMPLE_EVERY", "100"))
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_SAMPLE_EVERY)
+
 # Получаем токен из переменных окружения
 TELEGRAM_BOT_TOKEN = os.getenv("BOT_TOKEN")
 # ID вашего основного канала - можно использовать числовой ID или юзернейм
@@ -29,171 +162,766 @@ MAIN_CHANNEL_ID = "@GiveawaydogSteamEgs"  # замените на ваш кан
 
 # Проверяем, что токен загрузился
 if not TELEGRAM_BOT_TOKEN:
-    print("❌ ОШИБКА: Токен не найден в .env файле!")
-    print(f"📁 Текущая папка: {Path(__file__).parent}")
-    print("📄 Создайте файл .env с содержимым: BOT_TOKEN=ваш_токен")
+    log.error("❌ ОШИБКА: Токен не найден в .env файле!")
+    log.info("📁 Текущая папка: %s", Path(__file__).parent)
+    log.info("📄 Создайте файл .env с содержимым: BOT_TOKEN=ваш_токен")
     exit(1)
 else:
-    print(f"✅ Токен загружен: {TELEGRAM_BOT_TOKEN[:10]}...")
+    log.info("✅ Токен загружен: %s...", TELEGRAM_BOT_TOKEN[:10])
 
 # Ваш Telegram ID (замените на свой)
 YOUR_ADMIN_ID = 1035969773
 
-# Файл для сохранения подписанных пользователей
-if os.path.exists('/app/data/users.json'):
+# Адрес Bot API (можно указать локальный фейковый Telegram для тестов)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org/bot")
+
+# Получение обновлений: polling (getUpdates) или webhook (локальный HTTP-сервер)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный https-адрес, например https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")  # где слушать локальный сервер
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # сверяется с X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = 40  # сколько соединений Telegram может открыть к вебхуку
+WEBHOOK_DRAIN_TIMEOUT = 30  # сколько ждать обработки принятых обновлений при остановке (сек)
+UPDATE_CONCURRENCY = 32  # сколько обновлений обрабатывается одновременно
+USER_TASK_CONCURRENCY = 8  # сколько долгих фоновых задач пользователей (показ предложений) одновременно
+
+# Метрики в формате Prometheus на локальном HTTP-сервере (порт 0 - выключить)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+
+# Локальный HTTP-сервер
+HTTP_SERVER_TIMEOUT = 10  # таймаут чтения запроса (сек)
+HTTP_SERVER_MAX_BODY = 1024 * 1024  # максимальный размер тела запроса
+
+# Файлы данных. JSON-файлы нужны только для однократной миграции в SQLite
+if os.path.exists('/app/data/users.json') or os.path.exists('/app/data/bot.db'):
+    DB_FILE = '/app/data/bot.db'
     USERS_FILE = '/app/data/users.json'
     NOTIFIED_GAMES_FILE = '/app/data/notified_games.json'
     USER_SETTINGS_FILE = '/app/data/user_settings.json'
     PENDING_USERS_FILE = '/app/data/pending_users.json'
+    APPDETAILS_CACHE_FILE = '/app/data/appdetails_cache.db'
 else:
     SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+    DB_FILE = os.path.join(SCRIPT_DIR, "bot.db")
     USERS_FILE = os.path.join(SCRIPT_DIR, "users.json")
     NOTIFIED_GAMES_FILE = os.path.join(SCRIPT_DIR, "notified_games.json")
     USER_SETTINGS_FILE = os.path.join(SCRIPT_DIR, "user_settings.json")
     PENDING_USERS_FILE = os.path.join(SCRIPT_DIR, "pending_users.json")
+    APPDETAILS_CACHE_FILE = os.path.join(SCRIPT_DIR, "appdetails_cache.db")
+
+# Журнал базы (WAL): до какого размера урезать его после сброса в основной файл
+DB_WAL_SIZE_LIMIT = 4 * 1024 * 1024  # 4 МБ
 
 # Интервал проверки (в секундах)
 CHECK_INTERVAL = 3600  # 1 час
 
+# Расписание источников: у каждого свой интервал опроса (в секундах)
+STEAM_FREE_CHECK_INTERVAL = CHECK_INTERVAL  # 1 час
+STEAM_DISCOUNTS_CHECK_INTERVAL = 30 * 60  # распродажи Steam меняются непредсказуемо
+EPIC_CHECK_INTERVAL = 6 * 3600  # между границами раздач Epic (сами границы будят точно)
+SOURCE_JITTER = 0.1  # случайный разброс интервала (доля от интервала)
+SOURCE_RETRY_DELAY = 60  # пауза после первой ошибки, дальше удваивается
+EPIC_WAKEUP_GRACE = 60  # через сколько секунд после границы раздачи перепроверять Epic
+
+# Состояние предложений: вернувшаяся раздача или скидка объявляется заново,
+# если она пропадала дольше DEAL_RETURN_COOLDOWN (короткие пропадания не в счет)
+DEAL_RETURN_COOLDOWN = 24 * 3600  # 1 день
+DEAL_STATE_RETENTION = 30 * 24 * 3600  # сколько хранить закончившиеся предложения
+
+# Сколько помнить отправленные игры, чтобы не слать их повторно (в секундах)
+NOTIFIED_RETENTION = {
+    'steam': 7 * 24 * 3600,  # бесплатные игры Steam
+    'epic': 7 * 24 * 3600,  # раздачи Epic
+    'discount': 7 * 24 * 3600,  # скидки Steam
+}
+
+# Сколько секунд снимок текущих предложений считается свежим для /start
+DEALS_SNAPSHOT_TTL = CHECK_INTERVAL + 600
+
+# Рассылка: глобальный лимит Telegram ~30 сообщений/сек и 1 сообщение/сек в один чат
+BROADCAST_GLOBAL_RATE = 28  # сообщений в секунду на весь бот
+BROADCAST_PER_CHAT_INTERVAL = 1.0  # секунд между сообщениями в один чат
+BROADCAST_CONCURRENCY = 16  # параллельных отправителей
+BROADCAST_MAX_RETRIES = 3  # повторов после RetryAfter и сетевых ошибок
+BROADCAST_PROGRESS_INTERVAL = 5  # как часто сообщать о прогрессе (сек)
+
+# Кэш подписки на канал: результат get_chat_member живет недолго
+MEMBERSHIP_POSITIVE_TTL = 10 * 60  # подписан - не перепроверять 10 минут
+MEMBERSHIP_NEGATIVE_TTL = 10  # не подписан - пользователь может подписаться прямо сейчас
+MEMBERSHIP_CACHE_SIZE = 10000  # записей в памяти
+# Фоновая перепроверка подписчиков: кто отписался от канала, удаляется из рассылки
+MEMBERSHIP_REVALIDATE_INTERVAL = 24 * 3600  # раз в сутки
+MEMBERSHIP_REVALIDATE_BATCH = 20  # проверок одной пачкой
+MEMBERSHIP_REVALIDATE_RATE = 5  # проверок в секунду
+
+# Дайджест: новые предложения копятся DIGEST_WINDOW секунд и уходят одним
+# сообщением на пользователя (с учетом его notify_free/notify_discounts)
+DIGEST_MODE = os.getenv("DIGEST_MODE", "0").lower() in ("1", "true", "yes", "on")  # 1 - дайджесты вместо отдельных сообщений
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", "120"))  # сколько секунд собирать предложения после первого
+DIGEST_MAX_ITEMS = int(os.getenv("DIGEST_MAX_ITEMS", "10"))  # не больше предложений в одном сообщении
+
+# Настройки HTTP-клиента для парсеров магазинов
+HTTP_TIMEOUT = 15  # общий таймаут запроса (сек)
+HTTP_CONNECT_TIMEOUT = 5  # таймаут установки соединения (сек)
+HTTP_MAX_CONNECTIONS = 20  # всего соединений в пуле
+HTTP_MAX_CONNECTIONS_PER_HOST = 6  # одновременных запросов к одному хосту
+HTTP_KEEPALIVE_EXPIRY = 60  # сколько держать простаивающее соединение (сек)
+HTTP_USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+# Бюджет запросов по хостам: (запросов в секунду, размер всплеска)
+HTTP_HOST_RATE_LIMITS = {
+    'store.steampowered.com': (5, 40),
+}
+
+# Сколько запросов appdetails выполнять параллельно
+APPDETAILS_CONCURRENCY = 8
+# Глубокий обход распродажи Steam: все страницы поиска параллельно
+STEAM_DEEP_SCAN = True  # False - смотреть только первую страницу
+STEAM_SCAN_PAGE_SIZE = 100  # строк на странице поиска
+STEAM_SCAN_MAX_PAGES = 50  # не больше страниц за проверку
+STEAM_SCAN_CONCURRENCY = 4  # страниц загружается одновременно
+STEAM_SCAN_TIME_BUDGET = 60  # сек на обход страниц поиска (appdetails и featuredcategories - сверх него)
+STEAM_SCAN_PAGE_TIMEOUT = 15  # сек на одну страницу
+
+# Сколько игр запрашивать одним пакетным запросом цен appdetails
+APPDETAILS_PRICE_BATCH = 50
+
+# Кэш appdetails: статичные данные меняются редко, цены - часто
+APPDETAILS_CACHE_SIZE = 2000  # записей в памяти
+APPDETAILS_STATIC_TTL = 7 * 24 * 3600  # 7 дней
+APPDETAILS_PRICE_TTL = 30 * 60  # 30 минут
+
+# Сколько готовых сообщений об играх держать в памяти
+RENDER_CACHE_SIZE = 500
+
 
 # =============================================================================
-# УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ И НАСТРОЙКАМИ
+# МЕТРИКИ
+# =============================================================================
+
+# Все созданные метрики в порядке объявления (для /metrics и /stats)
+METRICS = []
+
+# Границы бакетов гистограмм по умолчанию (секунды)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PROCESS_STARTED_AT = time.time()
+
+
+class Metric:
+    """Метрика в формате Prometheus: значения по кортежам значений меток.
+
+    Вместо накопленных значений можно передать collect() - функцию, которая
+    в момент выгрузки возвращает {кортеж меток: значение}. Так снимаются
+    размеры очередей и счетчики, которые уже ведут другие объекты.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help_text, labels=(), collect=None):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values = {}
+        METRICS.append(self)
+
+    def values(self):
+        return self.collect() if self.collect else self._values
+
+    def get(self, *label_values):
+        return self.values().get(label_values, 0)
+
+    def samples(self):
+        """(суффикс, значения меток, доп. метки, значение) для выгрузки"""
+        for label_values, value in self.values().items():
+            yield '', label_values, (), value
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        self._values[label_values] = value
+
+
+class Histogram(Metric):
+    """Гистограмма: количество наблюдений по бакетам, сумма и число"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        state = self._values.get(label_values)
+        if state is None:
+            state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """Замеряет длительность блока with"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def summary(self, *label_values):
+        """(число наблюдений, сумма) для меток"""
+        state = self._values.get(label_values)
+        return (state[2], state[1]) if state else (0, 0.0)
+
+    def samples(self):
+        for label_values, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                yield '_bucket', label_values, (('le', le),), cumulative
+            yield '_sum', label_values, (), total
+            yield '_count', label_values, (), count
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def render_metrics():
+    """Текст всех метрик в формате Prometheus exposition"""
+    lines = []
+    for metric in METRICS:
+        try:
+            samples = list(metric.samples())
+        except Exception as e:
+            log.warning("⚠️ Ошибка сбора метрики %s: %s", metric.name, e)
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for suffix, label_values, extra, value in samples:
+            lines.append(f"{metric.name}{suffix}{_format_labels(metric.labels, label_values, extra)} {value}")
+    return '\n'.join(lines) + '\n'
+
+
+SOURCE_FETCHES = Counter('steambot_source_fetches_total', 'Опросы источников предложений', ('source', 'result'))
+SOURCE_FETCH_SECONDS = Histogram('steambot_source_fetch_seconds', 'Длительность опроса источника', ('source',))
+SOURCE_GAMES = Gauge('steambot_source_games', 'Предложений в последнем ответе источника', ('source',))
+HTTP_REQUESTS = Counter('steambot_http_requests_total', 'HTTP-запросы парсеров', ('host', 'status'))
+HTTP_REQUEST_SECONDS = Histogram('steambot_http_request_seconds', 'Длительность HTTP-запросов парсеров', ('host',))
+TELEGRAM_MESSAGES = Counter('steambot_telegram_messages_total', 'Итоги отправки сообщений', ('outcome',))
+TELEGRAM_RETRY_AFTER = Counter('steambot_telegram_retry_after_total', 'Ответы RetryAfter от Telegram')
+TELEGRAM_SEND_SECONDS = Histogram('steambot_telegram_send_seconds', 'Длительность вызова sendMessage')
+BROADCAST_RATE = Gauge('steambot_broadcast_messages_per_second', 'Скорость последней рассылки')
+UPDATE_SECONDS = Histogram('steambot_update_seconds', 'Длительность обработки обновления Telegram')
+DB_WRITE_SECONDS = Histogram('steambot_db_write_seconds', 'Длительность записи в базу', ('op',))
+CACHE_EVENTS = Counter(
+    'steambot_cache_events_total', 'Попадания и промахи кэшей', ('cache', 'event'),
+    collect=lambda: {
+        **{('appdetails', event): value for event, value in appdetails_cache.stats.items()},
+        ('render', 'hits'): render_cache_stats['hits'],
+        ('render', 'misses'): render_cache_stats['misses'],
+        ('membership', 'hits'): membership_cache.hits,
+        ('membership', 'misses'): membership_cache.misses
+    }
+)
+SUBSCRIBERS = Gauge(
+    'steambot_subscribers', 'Подписчиков рассылки',
+    collect=lambda: {(): get_db().execute("SELECT COUNT(*) FROM users").fetchone()[0]}
+)
+BROADCAST_JOBS_OPEN = Gauge(
+    'steambot_broadcast_jobs_open', 'Незавершенных заданий рассылки',
+    collect=lambda: {(): get_db().execute(
+        "SELECT COUNT(*) FROM broadcast_jobs WHERE status != 'done'"
+    ).fetchone()[0]}
+)
+UPTIME = Gauge('steambot_uptime_seconds', 'Время работы процесса',
+               collect=lambda: {(): round(time.time() - PROCESS_STARTED_AT, 1)})
+
+
+# =============================================================================
+# ХРАНИЛИЩЕ (SQLite)
 # =============================================================================
 
-def load_pending_users():
-    """Загружает список пользователей, ожидающих подтверждения подписки"""
-    if os.path.exists(PENDING_USERS_FILE):
-        with open(PENDING_USERS_FILE, 'r', encoding='utf-8') as f:
+_db = None
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    chat_id INTEGER PRIMARY KEY,
+    subscribed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_settings (
+    chat_id INTEGER PRIMARY KEY,
+    notify_free INTEGER NOT NULL DEFAULT 1,
+    notify_discounts INTEGER NOT NULL DEFAULT 0,
+    language TEXT NOT NULL DEFAULT 'ru'
+);
+CREATE TABLE IF NOT EXISTS pending_users (
+    chat_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    timestamp REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notified_games (
+    platform TEXT NOT NULL,
+    game_id TEXT NOT NULL,
+    notified_at REAL NOT NULL,
+    PRIMARY KEY (platform, game_id)
+);
+CREATE INDEX IF NOT EXISTS idx_notified_games_time ON notified_games (notified_at);
+CREATE TABLE IF NOT EXISTS dead_chats (
+    chat_id INTEGER PRIMARY KEY,
+    marked_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    created_at REAL NOT NULL,
+    finished_at REAL,
+    sent INTEGER,
+    failed INTEGER,
+    blocked INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs (status);
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    job_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (job_id, chat_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS feed_validators (
+    name TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    updated_at REAL
+);
+CREATE TABLE IF NOT EXISTS deal_state (
+    source TEXT NOT NULL,
+    game_id TEXT NOT NULL,
+    discount INTEGER,
+    final_price REAL,
+    end_date TEXT,
+    active INTEGER NOT NULL DEFAULT 1,
+    first_seen REAL NOT NULL,
+    changed_at REAL NOT NULL,
+    PRIMARY KEY (source, game_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS digest_items (
+    item_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Настройки, которые хранятся в колонках user_settings, и их значения по умолчанию
+USER_SETTING_DEFAULTS = {
+    "notify_free": True,
+    "notify_discounts": False,
+    "language": "ru"
+}
+
+
+def get_db():
+    """Возвращает соединение с базой (WAL), создавая схему при первом обращении.
+
+    Каждая отметка об отправке - одна строка INSERT, которая в режиме WAL
+    дописывается в конец журнала, а не переписывает файл. После сбоя SQLite
+    при открытии сам проигрывает журнал до последней завершенной транзакции.
+    """
+    global _db
+    if _db is None:
+        _db = sqlite3.connect(DB_FILE)
+        _db.execute("PRAGMA journal_mode=WAL")
+        _db.execute("PRAGMA synchronous=NORMAL")
+        _db.execute(f"PRAGMA journal_size_limit={DB_WAL_SIZE_LIMIT}")
+        _db.executescript(DB_SCHEMA)
+    return _db
+
+
+def checkpoint_db():
+    """Сбрасывает журнал WAL в основной файл базы и обрезает журнал.
+
+    Возвращает размер сброшенного журнала в байтах (0, если журнал был пуст
+    или его держит читатель).
+    """
+    wal_file = DB_FILE + '-wal'
+    try:
+        wal_size = os.path.getsize(wal_file) if os.path.exists(wal_file) else 0
+        with DB_WRITE_SECONDS.time('checkpoint'):
+            busy, _, _ = get_db().execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+    except (OSError, sqlite3.Error) as e:
+        log.error("❌ Ошибка сброса журнала базы: %s", e)
+        return 0
+    if busy:
+        log.warning("⚠️ Журнал базы занят, сброс отложен")
+        return 0
+    if wal_size:
+        log.info("💾 Журнал базы сброшен: %.1f КБ", wal_size / 1024)
+    return wal_size
+
+
+def close_db():
+    """Закрывает соединение с базой"""
+    global _db
+    if _db is not None:
+        _db.close()
+        _db = None
+
+
+def _read_json_file(path, default):
+    if os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
             return json.load(f)
-    return {"pending": {}}
+    return default
 
 
-def save_pending_users(pending_dict):
-    """Сохраняет список ожидающих пользователей"""
-    with open(PENDING_USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(pending_dict, f, ensure_ascii=False, indent=2)
+def migrate_json_storage():
+    """Однократно переносит данные из старых JSON-файлов в базу.
+
+    JSON-файлы не удаляются и остаются резервной копией.
+    """
+    db = get_db()
+    if db.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+        return
+
+    try:
+        users = _read_json_file(USERS_FILE, {"users": []})
+        settings = _read_json_file(USER_SETTINGS_FILE, {})
+        pending = _read_json_file(PENDING_USERS_FILE, {"pending": {}})
+        notified = _read_json_file(NOTIFIED_GAMES_FILE, {"steam": {}, "epic": {}})
+    except Exception as e:
+        log.error("❌ Ошибка чтения JSON-файлов для миграции: %s", e)
+        return
+
+    now = time.time()
+    with db:
+        db.executemany(
+            "INSERT OR IGNORE INTO users (chat_id, subscribed_at) VALUES (?, ?)",
+            [(int(chat_id), now) for chat_id in users.get("users", [])]
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO user_settings (chat_id, notify_free, notify_discounts, language) "
+            "VALUES (?, ?, ?, ?)",
+            [
+                (
+                    int(chat_id),
+                    int(bool(values.get("notify_free", USER_SETTING_DEFAULTS["notify_free"]))),
+                    int(bool(values.get("notify_discounts", USER_SETTING_DEFAULTS["notify_discounts"]))),
+                    values.get("language", USER_SETTING_DEFAULTS["language"])
+                )
+                for chat_id, values in settings.items()
+            ]
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO pending_users (chat_id, username, first_name, timestamp) VALUES (?, ?, ?, ?)",
+            [
+                (int(chat_id), info.get("username"), info.get("first_name"), info.get("timestamp", now))
+                for chat_id, info in pending.get("pending", {}).items()
+            ]
+        )
+        db.executemany(
+            "INSERT OR IGNORE INTO notified_games (platform, game_id, notified_at) VALUES (?, ?, ?)",
+            [
+                (platform, str(game_id), notified_at)
+                for platform, games in notified.items()
+                for game_id, notified_at in games.items()
+            ]
+        )
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', ?)", (str(now),))
 
+    log.info("📦 Миграция JSON -> SQLite: %s пользователей, %s настроек, %s ожидающих, %s отправленных игр",
+             len(users.get('users', [])), len(settings), len(pending.get('pending', {})),
+             sum(len(games) for games in notified.values()))
+
+
+# =============================================================================
+# УПРАВЛЕНИЕ ПОЛЬЗОВАТЕЛЯМИ И НАСТРОЙКАМИ
+# =============================================================================
 
 def add_pending_user(chat_id, username=None, first_name=None):
     """Добавляет пользователя в список ожидающих подтверждения"""
-    pending = load_pending_users()
-    if str(chat_id) not in pending["pending"]:
-        pending["pending"][str(chat_id)] = {
-            "username": username,
-            "first_name": first_name,
-            "timestamp": time.time()
-        }
-        save_pending_users(pending)
-        return True
-    return False
+    with get_db() as db:
+        cursor = db.execute(
+            "INSERT OR IGNORE INTO pending_users (chat_id, username, first_name, timestamp) VALUES (?, ?, ?, ?)",
+            (chat_id, username, first_name, time.time())
+        )
+    return cursor.rowcount > 0
 
 
 def remove_pending_user(chat_id):
     """Удаляет пользователя из списка ожидающих"""
-    pending = load_pending_users()
-    if str(chat_id) in pending["pending"]:
-        del pending["pending"][str(chat_id)]
-        save_pending_users(pending)
-        return True
-    return False
+    with get_db() as db:
+        cursor = db.execute("DELETE FROM pending_users WHERE chat_id = ?", (chat_id,))
+    return cursor.rowcount > 0
 
 
 def check_pending_user(chat_id):
     """Проверяет, ожидает ли пользователь подтверждения"""
-    pending = load_pending_users()
-    return str(chat_id) in pending["pending"]
+    return get_db().execute("SELECT 1 FROM pending_users WHERE chat_id = ?", (chat_id,)).fetchone() is not None
 
 
 def load_users():
-    """Загружает подписанных пользователей из файла"""
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {"users": []}
+    """Загружает подписанных пользователей"""
+    rows = get_db().execute("SELECT chat_id FROM users ORDER BY subscribed_at").fetchall()
+    return {"users": [row[0] for row in rows]}
 
 
-def save_users(users_dict):
-    """Сохраняет подписанных пользователей в файл"""
-    with open(USERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(users_dict, f, ensure_ascii=False, indent=2)
+def is_user_subscribed(chat_id):
+    """Проверяет, подписан ли пользователь на рассылку"""
+    return get_db().execute("SELECT 1 FROM users WHERE chat_id = ?", (chat_id,)).fetchone() is not None
 
 
 def add_user(chat_id):
     """Добавляет пользователя в список подписчиков"""
-    users = load_users()
-    if chat_id not in users["users"]:
-        users["users"].append(chat_id)
-        save_users(users)
-        init_user_settings(chat_id)
-        remove_pending_user(chat_id)
-        return True
-    return False
+    with get_db() as db:
+        cursor = db.execute("INSERT OR IGNORE INTO users (chat_id, subscribed_at) VALUES (?, ?)", (chat_id, time.time()))
+        if cursor.rowcount == 0:
+            return False
+        db.execute("INSERT OR IGNORE INTO user_settings (chat_id) VALUES (?)", (chat_id,))
+        db.execute("DELETE FROM pending_users WHERE chat_id = ?", (chat_id,))
+        db.execute("DELETE FROM dead_chats WHERE chat_id = ?", (chat_id,))
+    settings_repo.add(chat_id)
+    get_dead_chats().discard(chat_id)
+    return True
 
 
 def remove_user(chat_id):
     """Удаляет пользователя из списка подписчиков"""
-    users = load_users()
-    if chat_id in users["users"]:
-        users["users"].remove(chat_id)
-        save_users(users)
-        remove_user_settings(chat_id)
-        return True
-    return False
+    with get_db() as db:
+        cursor = db.execute("DELETE FROM users WHERE chat_id = ?", (chat_id,))
+        if cursor.rowcount == 0:
+            return False
+        db.execute("DELETE FROM user_settings WHERE chat_id = ?", (chat_id,))
+    settings_repo.remove(chat_id)
+    return True
+
+
+def remove_users(chat_ids, mark_dead=False):
+    """Удаляет сразу многих подписчиков одной транзакцией.
+
+    Из уже поставленных в очередь заданий такие чаты тоже убираются. С
+    mark_dead=True они также попадают в dead_chats: последующие рассылки
+    пропускают их без обращения к Telegram, а в открытых заданиях они
+    помечаются как заблокировавшие бота. Возвращает число удаленных.
+    """
+    chat_ids = list(dict.fromkeys(chat_ids))
+    if not chat_ids:
+        return 0
+
+    rows = [(chat_id,) for chat_id in chat_ids]
+    with DB_WRITE_SECONDS.time('remove_users'), get_db() as db:
+        before = db.total_changes
+        db.executemany("DELETE FROM users WHERE chat_id = ?", rows)
+        removed = db.total_changes - before
+        db.executemany("DELETE FROM user_settings WHERE chat_id = ?", rows)
+        open_jobs = [row[0] for row in db.execute("SELECT job_id FROM broadcast_jobs WHERE status != 'done'")]
+        pending = [(job_id, chat_id, RECIPIENT_PENDING) for job_id in open_jobs for chat_id in chat_ids]
+        if mark_dead:
+            now = time.time()
+            db.executemany(
+                "INSERT OR REPLACE INTO dead_chats (chat_id, marked_at) VALUES (?, ?)",
+                [(chat_id, now) for chat_id in chat_ids]
+            )
+            db.executemany(
+                "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND chat_id = ? AND status = ?",
+                [(RECIPIENT_STATUS['blocked'], *row) for row in pending]
+            )
+        else:
+            # Отписавшимся больше не шлем и то, что уже стоит в очереди
+            db.executemany(
+                "DELETE FROM broadcast_recipients WHERE job_id = ? AND chat_id = ? AND status = ?", pending
+            )
+
+    for chat_id in chat_ids:
+        settings_repo.remove(chat_id)
+    if mark_dead:
+        get_dead_chats().update(chat_ids)
+    return removed
+
+
+_dead_chats = None
+
+
+def get_dead_chats():
+    """Множество чатов, которые заблокировали бота (загружается один раз)"""
+    global _dead_chats
+    if _dead_chats is None:
+        _dead_chats = {row[0] for row in get_db().execute("SELECT chat_id FROM dead_chats")}
+    return _dead_chats
 
 
 # =============================================================================
 # НАСТРОЙКИ ПОЛЬЗОВАТЕЛЕЙ
 # =============================================================================
 
-def load_user_settings():
-    """Загружает настройки пользователей"""
-    if os.path.exists(USER_SETTINGS_FILE):
-        with open(USER_SETTINGS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
+# Какая настройка разрешает уведомления каждого типа
+NOTIFY_SETTING_BY_TYPE = {
+    'free': 'notify_free',
+    'discount': 'notify_discounts'
+}
+
+
+class SettingsRepository:
+    """Настройки подписчиков в памяти с готовыми индексами получателей.
+
+    Данные читаются из базы один раз, изменения пишутся по одной строке,
+    а для каждого типа уведомлений хранится множество chat_id получателей.
+    """
+
+    def __init__(self):
+        self._settings = None
+        self._recipients = {}
+        self._recipients_snapshot = {}
+
+    def _ensure_loaded(self):
+        if self._settings is None:
+            self.load()
+
+    def load(self):
+        """Загружает настройки всех подписчиков из базы"""
+        rows = get_db().execute(
+            "SELECT u.chat_id, s.notify_free, s.notify_discounts, s.language "
+            "FROM users u LEFT JOIN user_settings s ON s.chat_id = u.chat_id"
+        ).fetchall()
+
+        self._settings = {}
+        self._recipients = {key: set() for key in NOTIFY_SETTING_BY_TYPE.values()}
+        self._recipients_snapshot = {}
+        for chat_id, notify_free, notify_discounts, language in rows:
+            values = dict(USER_SETTING_DEFAULTS)
+            if notify_free is not None:
+                values.update(notify_free=bool(notify_free), notify_discounts=bool(notify_discounts), language=language)
+            self._store(chat_id, values)
+
+    def _store(self, chat_id, values):
+        self._settings[chat_id] = values
+        for key, recipients in self._recipients.items():
+            if values.get(key):
+                recipients.add(chat_id)
+            else:
+                recipients.discard(chat_id)
+        self._recipients_snapshot.clear()
+
+    def add(self, chat_id):
+        """Регистрирует нового подписчика с настройками по умолчанию"""
+        self._ensure_loaded()
+        if chat_id not in self._settings:
+            self._store(chat_id, dict(USER_SETTING_DEFAULTS))
+
+    def remove(self, chat_id):
+        """Убирает подписчика из памяти и из всех индексов"""
+        self._ensure_loaded()
+        if self._settings.pop(chat_id, None) is not None:
+            for recipients in self._recipients.values():
+                recipients.discard(chat_id)
+            self._recipients_snapshot.clear()
+
+    def get(self, chat_id, key, default=None):
+        """Возвращает настройку подписчика без обращения к базе"""
+        self._ensure_loaded()
+        return self._settings.get(chat_id, {}).get(key, default)
+
+    def set(self, chat_id, key, value):
+        """Меняет одну настройку подписчика и записывает только его строку"""
+        if key not in USER_SETTING_DEFAULTS:
+            raise KeyError(key)
+        self._ensure_loaded()
+        values = dict(self._settings.get(chat_id, USER_SETTING_DEFAULTS))
+        values[key] = value
+        with get_db() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO user_settings (chat_id, notify_free, notify_discounts, language) "
+                "VALUES (?, ?, ?, ?)",
+                (chat_id, int(values["notify_free"]), int(values["notify_discounts"]), values["language"])
+            )
+        self._store(chat_id, values)
+
+    def all(self):
+        """Копия настроек всех подписчиков: {chat_id: {...}}"""
+        self._ensure_loaded()
+        return {chat_id: dict(values) for chat_id, values in self._settings.items()}
+
+    def recipients(self, setting_key):
+        """Неизменяемое множество подписчиков, у которых включена настройка"""
+        self._ensure_loaded()
+        snapshot = self._recipients_snapshot.get(setting_key)
+        if snapshot is None:
+            snapshot = frozenset(self._recipients.get(setting_key, ()))
+            self._recipients_snapshot[setting_key] = snapshot
+        return snapshot
+
+    def recipients_for(self, game_type):
+        """Получатели уведомления указанного типа ('free' или 'discount')"""
+        return self.recipients(NOTIFY_SETTING_BY_TYPE[game_type])
 
 
-def save_user_settings(settings):
-    """Сохраняет настройки пользователей"""
-    with open(USER_SETTINGS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(settings, f, ensure_ascii=False, indent=2)
+settings_repo = SettingsRepository()
+
+
+def load_user_settings():
+    """Загружает настройки пользователей"""
+    return {str(chat_id): values for chat_id, values in settings_repo.all().items()}
 
 
 def init_user_settings(chat_id):
     """Инициализирует настройки для нового пользователя"""
-    settings = load_user_settings()
-    if str(chat_id) not in settings:
-        settings[str(chat_id)] = {
-            "notify_free": True,
-            "notify_discounts": False,
-            "language": "ru"
-        }
-        save_user_settings(settings)
+    with get_db() as db:
+        db.execute("INSERT OR IGNORE INTO user_settings (chat_id) VALUES (?)", (chat_id,))
+    settings_repo.add(chat_id)
 
 
 def remove_user_settings(chat_id):
     """Удаляет настройки пользователя"""
-    settings = load_user_settings()
-    if str(chat_id) in settings:
-        del settings[str(chat_id)]
-        save_user_settings(settings)
+    with get_db() as db:
+        db.execute("DELETE FROM user_settings WHERE chat_id = ?", (chat_id,))
+    settings_repo.remove(chat_id)
 
 
 def get_user_setting(chat_id, key, default=None):
     """Получает конкретную настройку пользователя"""
-    settings = load_user_settings()
-    user_settings = settings.get(str(chat_id), {})
-    return user_settings.get(key, default)
+    return settings_repo.get(chat_id, key, default)
+
+
+def set_user_setting(chat_id, key, value):
+    """Изменяет конкретную настройку пользователя"""
+    settings_repo.set(chat_id, key, value)
 
 
 # =============================================================================
 # ПРОВЕРКА ПОДПИСКИ НА КАНАЛ (ИСПРАВЛЕННАЯ ВЕРСИЯ)
 # =============================================================================
 
-async def check_channel_subscription(bot, user_id, channel_id):
-    """Проверяет, подписан ли пользователь на канал"""
+async def _fetch_channel_membership(bot, user_id, channel_id):
+    """Спрашивает у Telegram, подписан ли пользователь на канал.
+
+    Возвращает True/False или None, если ответа получить не удалось (канал
+    не найден, бот не админ, сетевая ошибка) - такой результат не кэшируется
+    и не считается отпиской.
+    """
     try:
-        print(f"🔍 Проверяю подписку пользователя {user_id} на канал {channel_id}")
+        log.debug("🔍 Проверяю подписку пользователя %s на канал %s", user_id, channel_id)
 
         # Пытаемся получить информацию о пользователе в канале
         chat_member = await bot.get_chat_member(chat_id=channel_id, user_id=user_id)
@@ -201,21 +929,93 @@ async def check_channel_subscription(bot, user_id, channel_id):
         # Статусы, которые считаются подпиской
         valid_statuses = ['member', 'administrator', 'creator']
 
-        print(f"📊 Статус пользователя: {chat_member.status}")
+        log.debug("📊 Статус пользователя %s: %s", user_id, chat_member.status)
 
+        # Ограниченный участник остается в канале, если is_member
+        if chat_member.status == 'restricted':
+            return bool(getattr(chat_member, 'is_member', False))
         return chat_member.status in valid_statuses
 
     except BadRequest as e:
         # Ошибка BadRequest может быть если бот не админ или канал не существует
-        print(f"❌ Ошибка BadRequest при проверке подписки: {e}")
+        log.error("❌ Ошибка BadRequest при проверке подписки: %s", e)
+        if "user not found" in str(e).lower():
+            log.warning("⚠️ Пользователь %s не найден в канале", user_id)
+            return False
         if "chat not found" in str(e).lower():
-            print(f"⚠️ Канал {channel_id} не найден или бот не добавлен в канал!")
-        elif "user not found" in str(e).lower():
-            print(f"⚠️ Пользователь {user_id} не найден в канале")
-        return False
+            log.warning("⚠️ Канал %s не найден или бот не добавлен в канал!", channel_id)
+        return None
     except Exception as e:
-        print(f"⚠️ Неожиданная ошибка при проверке подписки: {e}")
-        return False
+        log.warning("⚠️ Неожиданная ошибка при проверке подписки: %s", e)
+        return None
+
+
+
+class MembershipCache:
+    """Кэш подписки на канал с дедупликацией одновременных проверок.
+
+    "Подписан" помнится MEMBERSHIP_POSITIVE_TTL, "не подписан" - только
+    MEMBERSHIP_NEGATIVE_TTL, чтобы только что подписавшийся пользователь не
+    ждал. Повторные нажатия кнопки, пока запрос к Telegram еще идет, ждут
+    этот же запрос.
+    """
+
+    def __init__(self, positive_ttl=MEMBERSHIP_POSITIVE_TTL, negative_ttl=MEMBERSHIP_NEGATIVE_TTL,
+                 max_items=MEMBERSHIP_CACHE_SIZE):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_items = max_items
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _cached(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        is_member, checked_at = entry
+        ttl = self.positive_ttl if is_member else self.negative_ttl
+        if time.monotonic() - checked_at >= ttl:
+            del self._entries[key]
+            return None
+        return is_member
+
+    def _store(self, key, future):
+        self._inflight.pop(key, None)
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            return
+        self._entries[key] = (future.result(), time.monotonic())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_items:
+            self._entries.popitem(last=False)
+
+    async def check(self, bot, user_id, channel_id):
+        """True/False - подписан ли пользователь, None - выяснить не удалось"""
+        key = (channel_id, user_id)
+        cached = self._cached(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(_fetch_channel_membership(bot, user_id, channel_id))
+            self._inflight[key] = future
+            future.add_done_callback(lambda done: self._store(key, done))
+        return await asyncio.shield(future)
+
+    def invalidate(self, user_id, channel_id):
+        self._entries.pop((channel_id, user_id), None)
+
+
+membership_cache = MembershipCache()
+
+
+async def check_channel_subscription(bot, user_id, channel_id):
+    """Проверяет, подписан ли пользователь на канал (через кэш)"""
+    return bool(await membership_cache.check(bot, user_id, channel_id))
 
 
 # =============================================================================
@@ -230,7 +1030,8 @@ async def cmd_check_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ У вас нет прав на эту команду")
         return
 
-    # Проверяем для текущего пользователя
+    # Проверяем для текущего пользователя в обход кэша
+    membership_cache.invalidate(chat_id, MAIN_CHANNEL_ID)
     is_subscribed = await check_channel_subscription(context.bot, chat_id, MAIN_CHANNEL_ID)
 
     status_text = "✅ Подписан" if is_subscribed else "❌ НЕ подписан"
@@ -252,127 +1053,784 @@ async def cmd_check_sub(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ (без изменений)
 # =============================================================================
 
+class NotifiedGames:
+    """Уже отправленные игры с индексом по сроку истечения.
+
+    Словари по платформам отвечают на вопрос "уже отправляли?", а куча
+    (expires_at, platform, game_id) позволяет чистить за O(истекших): при
+    очистке смотрится только вершина кучи. Скидки лежат на платформе steam
+    с префиксом discount_, но живут по сроку NOTIFIED_RETENTION['discount'].
+    """
+
+    def __init__(self, retention=None):
+        self.retention = retention or NOTIFIED_RETENTION
+        self._games = {"steam": {}, "epic": {}}
+        self._expiry = []
+
+    def _expires_at(self, platform, game_id, notified_at):
+        namespace = 'discount' if game_id.startswith('discount_') else platform
+        return notified_at + self.retention.get(namespace, max(self.retention.values()))
+
+    def contains(self, platform, game_id):
+        return str(game_id) in self._games.get(platform, {})
+
+    def mark(self, platform, game_id, notified_at):
+        """Отмечает игру отправленной (в базу ее уже записал enqueue_broadcast_job)"""
+        game_id = str(game_id)
+        self._games.setdefault(platform, {})[game_id] = notified_at
+        heapq.heappush(self._expiry, (self._expires_at(platform, game_id, notified_at), platform, game_id))
+
+    def count(self, platform):
+        return len(self._games.get(platform, {}))
+
+    def expire(self, now=None):
+        """Удаляет истекшие отметки из памяти и базы.
+
+        В базу пишет, только если что-то действительно истекло. Возвращает
+        список удаленных (platform, game_id).
+        """
+        now = now or time.time()
+        removed = []
+        while self._expiry and self._expiry[0][0] <= now:
+            expires_at, platform, game_id = heapq.heappop(self._expiry)
+            notified_at = self._games.get(platform, {}).get(game_id)
+            # Если игру отметили заново, в куче есть ее более поздний элемент
+            if notified_at is None or self._expires_at(platform, game_id, notified_at) != expires_at:
+                continue
+            del self._games[platform][game_id]
+            removed.append((platform, game_id))
+
+        if removed:
+            try:
+                with DB_WRITE_SECONDS.time('expire'), get_db() as db:
+                    db.executemany("DELETE FROM notified_games WHERE platform = ? AND game_id = ?", removed)
+            except Exception as e:
+                log.error("❌ Ошибка при очистке notified_games: %s", e)
+            log.info("🧹 Очистка: удалено %s отметок об отправке", len(removed))
+        return removed
+
+
 def load_notified_games():
-    """Загружает список уже отправленных игр из файла"""
+    """Загружает список уже отправленных игр"""
+    games = NotifiedGames()
     try:
-        if os.path.exists(NOTIFIED_GAMES_FILE):
-            with open(NOTIFIED_GAMES_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                print(f"📂 Загружено {len(data.get('steam', {}))} Steam и {len(data.get('epic', {}))} Epic игр")
-                return data
-        else:
-            print("📂 Файл notified_games.json не найден, создаем новый")
-            return {"steam": {}, "epic": {}}
+        rows = get_db().execute("SELECT platform, game_id, notified_at FROM notified_games").fetchall()
+        for platform, game_id, notified_at in rows:
+            games.mark(platform, game_id, notified_at)
+        log.info("📂 Загружено %s Steam и %s Epic игр", games.count('steam'), games.count('epic'))
     except Exception as e:
-        print(f"❌ Ошибка загрузки notified_games: {e}")
-        return {"steam": {}, "epic": {}}
+        log.error("❌ Ошибка загрузки notified_games: %s", e)
+    return games
 
 
-def save_notified_games(games_dict):
-    """Сохраняет список отправленных игр в файл"""
-    try:
-        steam_count = len(games_dict.get('steam', {}))
-        epic_count = len(games_dict.get('epic', {}))
-        print(f"💾 Сохраняю {steam_count} Steam и {epic_count} Epic игр в {NOTIFIED_GAMES_FILE}")
+# =============================================================================
+# HTTP-КЛИЕНТ (общий пул соединений для парсеров)
+# =============================================================================
 
-        with open(NOTIFIED_GAMES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(games_dict, f, ensure_ascii=False, indent=2)
+_http_client = None
+_host_semaphores = {}
+_host_rate_limiters = {}
+
+
+class AsyncTokenBucket:
+    """Асинхронный token bucket: не больше rate операций в секунду, всплеск до capacity"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens=1):
+        """Ждет, пока в ведре не появится нужное количество токенов"""
+        async with self._lock:
+            while True:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                    self._updated = time.monotonic()
+                    continue
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        """Останавливает выдачу токенов на seconds секунд (например, после RetryAfter)"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+
+def get_http_client():
+    """Возвращает общий асинхронный HTTP-клиент с keep-alive пулом соединений"""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            headers={'User-Agent': HTTP_USER_AGENT},
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+            ),
+            follow_redirects=True
+        )
+    return _http_client
+
+
+def _get_host_semaphore(url):
+    """Семафор, ограничивающий число одновременных запросов к одному хосту"""
+    host = httpx.URL(url).host
+    semaphore = _host_semaphores.get(host)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(HTTP_MAX_CONNECTIONS_PER_HOST)
+        _host_semaphores[host] = semaphore
+    return semaphore
+
+
+def _get_host_rate_limiter(url):
+    """Ограничитель частоты запросов к хосту (None, если бюджет не задан)"""
+    host = httpx.URL(url).host
+    if host not in HTTP_HOST_RATE_LIMITS:
+        return None
+    limiter = _host_rate_limiters.get(host)
+    if limiter is None:
+        rate, burst = HTTP_HOST_RATE_LIMITS[host]
+        limiter = AsyncTokenBucket(rate, burst)
+        _host_rate_limiters[host] = limiter
+    return limiter
+
+
+async def http_get(url, params=None, headers=None, timeout=None):
+    """Выполняет GET-запрос через общий пул, не блокируя event loop"""
+    client = get_http_client()
+    limiter = _get_host_rate_limiter(url)
+    if limiter is not None:
+        await limiter.acquire()
+    host = httpx.URL(url).host
+    async with _get_host_semaphore(url):
+        started = time.perf_counter()
+        try:
+            response = await client.get(
+                url,
+                params=params,
+                headers=headers,
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            )
+        except httpx.HTTPError:
+            HTTP_REQUESTS.inc(host, 'error')
+            raise
+        finally:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, host)
+        HTTP_REQUESTS.inc(host, str(response.status_code))
+        return response
 
-        if os.path.exists(NOTIFIED_GAMES_FILE):
-            size = os.path.getsize(NOTIFIED_GAMES_FILE)
-            print(f"✅ Файл сохранен, размер: {size} байт")
-        else:
-            print(f"❌ Файл не создался!")
-    except Exception as e:
-        print(f"❌ Ошибка при сохранении notified_games: {e}")
-        import traceback
-        traceback.print_exc()
 
+# Последняя разобранная версия каждой ленты: {name: {'result': ..., 'hash': ...}}
+_feed_cache = {}
 
-def clean_old_games(games_dict, days=7):
-    """Удаляет игры, отправленные более X дней назад"""
-    current_time = time.time()
-    max_age = days * 24 * 60 * 60
 
-    cleaned = {"steam": {}, "epic": {}}
-    removed_count = {"steam": 0, "epic": 0}
+def _load_feed_validators(name):
+    row = get_db().execute(
+        "SELECT etag, last_modified, content_hash FROM feed_validators WHERE name = ?", (name,)
+    ).fetchone()
+    return row or (None, None, None)
 
-    for platform in ["steam", "epic"]:
-        for game_id, notified_at in games_dict.get(platform, {}).items():
-            age = current_time - notified_at
-            if age < max_age:
-                cleaned[platform][game_id] = notified_at
-            else:
-                removed_count[platform] += 1
 
-    total_removed = sum(removed_count.values())
-    if total_removed > 0:
-        print(f"🧹 Очистка: {removed_count['steam']} Steam, {removed_count['epic']} Epic удалено (> {days} дней)")
+def _save_feed_validators(name, response, content_hash):
+    with get_db() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO feed_validators (name, etag, last_modified, content_hash, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (name, response.headers.get('ETag'), response.headers.get('Last-Modified'), content_hash, time.time())
+        )
 
-    return cleaned
+
+async def fetch_feed(name, url, parse, params=None, headers=None, timeout=None):
+    """Условный GET JSON-ленты с разбором только при изменении содержимого.
+
+    Хранит ETag/Last-Modified и хэш содержимого. Если сервер ответил 304 или
+    пришли те же байты, parse не вызывается и возвращается прошлый результат.
+    parse(data) может быть обычной функцией или корутиной. Возвращает
+    (result, changed); result равен None, если ленту получить не удалось.
+    """
+    etag, last_modified, known_hash = _load_feed_validators(name)
+    cached = _feed_cache.get(name)
+
+    request_headers = dict(headers or {})
+    if cached is not None:
+        if etag:
+            request_headers['If-None-Match'] = etag
+        if last_modified:
+            request_headers['If-Modified-Since'] = last_modified
+
+    response = await http_get(url, params=params, headers=request_headers, timeout=timeout)
+
+    if response.status_code == 304 and cached is not None:
+        return cached['result'], False
+    if response.status_code != 200:
+        log.warning("⚠️ Лента %s: HTTP %s", name, response.status_code)
+        return None, False
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if cached is not None and cached['hash'] == content_hash:
+        _save_feed_validators(name, response, content_hash)
+        return cached['result'], False
+
+    result = parse(response.json())
+    if inspect.isawaitable(result):
+        result = await result
+
+    _feed_cache[name] = {'result': result, 'hash': content_hash}
+    _save_feed_validators(name, response, content_hash)
+    return result, content_hash != known_hash
+
+
+def get_feed_version(name):
+    """Хэш последней разобранной версии ленты (None, если ее еще не загружали)"""
+    cached = _feed_cache.get(name)
+    return cached['hash'] if cached else None
+
+
+@contextlib.asynccontextmanager
+async def http_stream(url, params=None, headers=None, timeout=None):
+    """Потоковый GET через общий пул: тело ответа читается по частям"""
+    client = get_http_client()
+    limiter = _get_host_rate_limiter(url)
+    if limiter is not None:
+        await limiter.acquire()
+    host = httpx.URL(url).host
+    async with _get_host_semaphore(url):
+        started = time.perf_counter()
+        try:
+            async with client.stream(
+                'GET',
+                url,
+                params=params,
+                headers=headers,
+                timeout=timeout if timeout is not None else httpx.USE_CLIENT_DEFAULT
+            ) as response:
+                HTTP_REQUESTS.inc(host, str(response.status_code))
+                yield response
+        except httpx.HTTPError:
+            HTTP_REQUESTS.inc(host, 'error')
+            raise
+        finally:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, host)
+
+
+async def close_http_client():
+    """Закрывает общий HTTP-клиент и все соединения пула"""
+    global _http_client
+    if _http_client is not None and not _http_client.is_closed:
+        await _http_client.aclose()
+    _http_client = None
 
 
 # =============================================================================
-# STEAM ФУНКЦИИ (без изменений)
+# КЭШ STEAM APPDETAILS
 # =============================================================================
 
-def is_game_free_to_play(app_id):
-    """Проверяет, является ли игра Free-to-Play в Steam"""
-    try:
-        url = f"https://store.steampowered.com/api/appdetails?appids={app_id}"
-        response = requests.get(url, timeout=10)
+class AppDetailsCache:
+    """Двухуровневый кэш appdetails по app_id: LRU в памяти + SQLite на диске.
+
+    Статичные данные (название, разработчик, жанры, is_free) и цены хранятся
+    с разными TTL, поэтому повторные проверки перезапрашивают только цены.
+    """
+
+    def __init__(self, path, max_items, static_ttl, price_ttl):
+        self.path = path
+        self.max_items = max_items
+        self.static_ttl = static_ttl
+        self.price_ttl = price_ttl
+        self.stats = {'static_hits': 0, 'static_misses': 0, 'price_hits': 0, 'price_misses': 0, 'disk_reads': 0}
+        self._memory = OrderedDict()
+        self._db = None
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS appdetails_cache ("
+                "app_id TEXT PRIMARY KEY, static_json TEXT, static_at REAL, price_json TEXT, price_at REAL)"
+            )
+        return self._db
 
-        if response.status_code == 200:
-            data = response.json()
-            if str(app_id) in data and data[str(app_id)]['success']:
-                game_data = data[str(app_id)]['data']
-                return game_data.get('is_free', False)
-    except:
-        pass
-    return False
+    def _load(self, app_id):
+        """Достает запись из памяти, а при промахе - с диска"""
+        entry = self._memory.get(app_id)
+        if entry is not None:
+            self._memory.move_to_end(app_id)
+            return entry
+
+        try:
+            row = self._connect().execute(
+                "SELECT static_json, static_at, price_json, price_at FROM appdetails_cache WHERE app_id = ?",
+                (app_id,)
+            ).fetchone()
+        except sqlite3.Error as e:
+            log.warning("⚠️ Ошибка чтения кэша appdetails: %s", e)
+            row = None
+
+        self.stats['disk_reads'] += 1
+        if row is None:
+            return None
+
+        entry = {
+            'static': json.loads(row[0]) if row[0] else None,
+            'static_at': row[1] or 0,
+            'price': json.loads(row[2]) if row[2] else None,
+            'price_at': row[3] or 0
+        }
+        self._remember(app_id, entry)
+        return entry
+
+    def _remember(self, app_id, entry):
+        self._memory[app_id] = entry
+        self._memory.move_to_end(app_id)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _get(self, app_id, part, ttl, count):
+        entry = self._load(str(app_id))
+        fresh = entry is not None and entry[part] is not None and time.time() - entry[f'{part}_at'] < ttl
+        if count:
+            self.stats[f'{part}_hits' if fresh else f'{part}_misses'] += 1
+        return entry[part] if fresh else None
+
+    def get_static(self, app_id, count=True):
+        """Статичные данные игры или None, если их нет или они устарели"""
+        return self._get(app_id, 'static', self.static_ttl, count)
+
+    def get_price(self, app_id, count=True):
+        """Ценовые данные игры или None, если их нет или они устарели"""
+        return self._get(app_id, 'price', self.price_ttl, count)
+
+    def put(self, app_id, static=None, price=None):
+        """Сохраняет статичные данные и/или цену игры в память и на диск"""
+        app_id = str(app_id)
+        now = time.time()
+        entry = self._load(app_id) or {'static': None, 'static_at': 0, 'price': None, 'price_at': 0}
+        if static is not None:
+            entry['static'], entry['static_at'] = static, now
+        if price is not None:
+            entry['price'], entry['price_at'] = price, now
+        self._remember(app_id, entry)
 
+        try:
+            db = self._connect()
+            db.execute(
+                "INSERT OR REPLACE INTO appdetails_cache (app_id, static_json, static_at, price_json, price_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    app_id,
+                    json.dumps(entry['static'], ensure_ascii=False) if entry['static'] is not None else None,
+                    entry['static_at'],
+                    json.dumps(entry['price']) if entry['price'] is not None else None,
+                    entry['price_at']
+                )
+            )
+            db.commit()
+        except sqlite3.Error as e:
+            log.warning("⚠️ Ошибка записи кэша appdetails: %s", e)
 
-def get_game_details(app_id):
-    """Получает полную информацию об игре в Steam, включая цену"""
+    def format_stats(self):
+        """Краткая строка со счетчиками попаданий и промахов"""
+        s = self.stats
+        return (
+            f"описания {s['static_hits']}/{s['static_hits'] + s['static_misses']}, "
+            f"цены {s['price_hits']}/{s['price_hits'] + s['price_misses']}, "
+            f"чтений с диска {s['disk_reads']}, в памяти {len(self._memory)}"
+        )
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+appdetails_cache = AppDetailsCache(
+    APPDETAILS_CACHE_FILE,
+    max_items=APPDETAILS_CACHE_SIZE,
+    static_ttl=APPDETAILS_STATIC_TTL,
+    price_ttl=APPDETAILS_PRICE_TTL
+)
+
+
+# =============================================================================
+# STEAM ФУНКЦИИ (без изменений)
+# =============================================================================
+
+def _parse_price_overview(price_overview):
+    """Приводит price_overview из appdetails к ценовой части описания игры"""
+    return {
+        'final_price': price_overview.get('final', 0) // 100 if price_overview else 0,
+        'original_price': price_overview.get('initial', 0) // 100 if price_overview else 0,
+        'discount_percent': price_overview.get('discount_percent', 0) if price_overview else 0,
+        'currency': price_overview.get('currency', 'RUB') if price_overview else 'RUB'
+    }
+
+
+async def _fetch_game_details(app_id):
+    """Загружает полную информацию об игре из appdetails и кладет ее в кэш"""
+    app_id = str(app_id)
     try:
         url = f"https://store.steampowered.com/api/appdetails?appids={app_id}&cc=ru&l=russian&v=1"
-        response = requests.get(url, timeout=15)
+        response = await http_get(url, timeout=15)
 
         if response.status_code == 200:
             data = response.json()
-            if str(app_id) in data and data[str(app_id)]['success']:
-                game_data = data[str(app_id)]['data']
+            if app_id in data and data[app_id]['success']:
+                game_data = data[app_id]['data']
                 price_overview = game_data.get('price_overview', {})
 
                 if not price_overview and game_data.get('is_free', False) == False:
                     price_url = f"https://store.steampowered.com/api/appdetails?appids={app_id}&cc=us&l=english"
-                    price_response = requests.get(price_url, timeout=10)
+                    price_response = await http_get(price_url, timeout=10)
                     if price_response.status_code == 200:
                         price_data = price_response.json()
-                        if str(app_id) in price_data and price_data[str(app_id)]['success']:
-                            price_overview = price_data[str(app_id)]['data'].get('price_overview', {})
+                        if app_id in price_data and price_data[app_id]['success']:
+                            price_overview = price_data[app_id]['data'].get('price_overview', {})
 
-                return {
+                static = {
                     'name': game_data.get('name', 'Неизвестно'),
                     'is_free': game_data.get('is_free', False),
-                    'final_price': price_overview.get('final', 0) // 100 if price_overview else 0,
-                    'original_price': price_overview.get('initial', 0) // 100 if price_overview else 0,
-                    'discount_percent': price_overview.get('discount_percent', 0),
-                    'currency': price_overview.get('currency', 'RUB'),
                     'release_date': game_data.get('release_date', {}).get('date', 'Неизвестно'),
                     'developer': game_data.get('developers', ['Неизвестно'])[0],
                     'publisher': game_data.get('publishers', ['Неизвестно'])[0],
                     'genres': [g['description'] for g in game_data.get('genres', [])],
                     'image': game_data.get('header_image', '')
                 }
+                price = _parse_price_overview(price_overview)
+                appdetails_cache.put(app_id, static=static, price=price)
+                return {**static, **price}
     except Exception as e:
-        print(f"⚠️ Ошибка получения данных для {app_id}: {e}")
+        log.warning("⚠️ Ошибка получения данных для %s: %s", app_id, e)
 
     return None
 
 
-def check_steam_free_games():
-    """Ищет игры со 100% скидкой в Steam"""
+async def _fetch_price_overviews(app_ids, country):
+    """Загружает только price_overview сразу для нескольких игр: {app_id: price_overview}"""
+    result = {}
+    for start in range(0, len(app_ids), APPDETAILS_PRICE_BATCH):
+        chunk = app_ids[start:start + APPDETAILS_PRICE_BATCH]
+        url = "https://store.steampowered.com/api/appdetails"
+        params = {'appids': ','.join(chunk), 'filters': 'price_overview', 'cc': country}
+        response = await http_get(url, params=params, timeout=15)
+
+        if response.status_code == 200:
+            data = response.json() or {}
+            for app_id in chunk:
+                entry = data.get(app_id) or {}
+                if entry.get('success'):
+                    # Для игр без цены Steam возвращает пустой список вместо словаря
+                    game_data = entry.get('data') or {}
+                    result[app_id] = game_data.get('price_overview', {}) if isinstance(game_data, dict) else {}
+    return result
+
+
+async def _refresh_prices(app_ids):
+    """Обновляет в кэше только цены игр, чье статичное описание еще актуально"""
+    prices = {}
+    try:
+        overviews = await _fetch_price_overviews(app_ids, 'ru')
+
+        missing = [
+            app_id for app_id in app_ids
+            if app_id in overviews and not overviews[app_id]
+            and not (appdetails_cache.get_static(app_id, count=False) or {}).get('is_free', False)
+        ]
+        if missing:
+            for app_id, price_overview in (await _fetch_price_overviews(missing, 'us')).items():
+                if price_overview:
+                    overviews[app_id] = price_overview
+
+        for app_id, price_overview in overviews.items():
+            prices[app_id] = _parse_price_overview(price_overview)
+            appdetails_cache.put(app_id, price=prices[app_id])
+    except Exception as e:
+        log.warning("⚠️ Ошибка обновления цен Steam: %s", e)
+
+    return prices
+
+
+async def is_game_free_to_play(app_id):
+    """Проверяет, является ли игра Free-to-Play в Steam"""
+    static = appdetails_cache.get_static(str(app_id))
+    if static is not None:
+        return static.get('is_free', False)
+
+    details = await _fetch_game_details(app_id)
+    return details.get('is_free', False) if details else False
+
+
+async def get_game_details(app_id):
+    """Получает полную информацию об игре в Steam, включая цену"""
+    return (await get_games_details([app_id])).get(str(app_id))
+
+
+async def _gather_by_app_id(fetch, app_ids, concurrency):
+    """Выполняет fetch для каждого app_id параллельно, не больше concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    unique_ids = list(dict.fromkeys(str(app_id) for app_id in app_ids))
+
+    async def run(app_id):
+        async with semaphore:
+            return app_id, await fetch(app_id)
+
+    return dict(await asyncio.gather(*(run(app_id) for app_id in unique_ids)))
+
+
+async def get_games_details(app_ids, concurrency=APPDETAILS_CONCURRENCY):
+    """Получает информацию о нескольких играх Steam параллельно: {app_id: details}
+
+    Статичные данные и цены берутся из кэша; если устарели только цены,
+    они перезапрашиваются одним пакетным запросом без полного appdetails.
+    """
+    details = {}
+    need_full = []
+    need_price = []
+
+    for app_id in dict.fromkeys(str(app_id) for app_id in app_ids):
+        static = appdetails_cache.get_static(app_id)
+        if static is None:
+            need_full.append(app_id)
+            continue
+        price = appdetails_cache.get_price(app_id)
+        if price is None:
+            need_price.append(app_id)
+        else:
+            details[app_id] = {**static, **price}
+
+    if need_price:
+        prices = await _refresh_prices(need_price)
+        for app_id in need_price:
+            static = appdetails_cache.get_static(app_id, count=False)
+            if app_id in prices and static is not None:
+                details[app_id] = {**static, **prices[app_id]}
+            else:
+                need_full.append(app_id)
+
+    if need_full:
+        details.update(await _gather_by_app_id(_fetch_game_details, need_full, concurrency))
+
+    return details
+
+
+async def check_games_free_to_play(app_ids, concurrency=APPDETAILS_CONCURRENCY):
+    """Проверяет несколько игр на Free-to-Play параллельно: {app_id: is_free}"""
+    return await _gather_by_app_id(is_game_free_to_play, app_ids, concurrency)
+
+
+def _price_amount(value):
+    """Целые цены остаются int, дробные - float с двумя знаками"""
+    return int(value) if value == int(value) else round(value, 2)
+
+
+def _parse_price_text(text):
+    """Превращает цену из HTML ('1 999 руб.', '$1,299.99', '0,99€') в число единиц валюты.
+
+    Дробной частью считаются одна-две цифры после последней точки или запятой,
+    остальные точки, запятые и пробелы - разделители тысяч.
+    """
+    match = re.search(r"\d(?:[\d\s\u00a0.,']*\d)?", text or '')
+    if not match:
+        return None
+    number = match.group(0)
+    fraction = re.search(r'[.,](\d{1,2})$', number)
+    if fraction:
+        whole = re.sub(r'\D', '', number[:fraction.start()]) or '0'
+        return _price_amount(float(f"{whole}.{fraction.group(1)}"))
+    return int(re.sub(r'\D', '', number))
+
+
+class SteamSearchParser(HTMLParser):
+    """Инкрементальный разбор HTML поиска Steam в строки результатов.
+
+    HTML подается по частям через feed(), готовые строки забираются через
+    pop_rows(). Строка: id, title, discount, original_price, final_price
+    (цены в целых единицах валюты; None, если блока цены в строке нет).
+    result_count - сколько строк результатов было в HTML, включая наборы,
+    которые в pop_rows() не попадают.
+    """
+
+    _CAPTURE_CLASSES = {
+        'title': 'title',
+        'discount_original_price': 'original_text',
+        'discount_final_price': 'final_text'
+    }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._rows = []
+        self._row = None
+        self._capture = None
+        self.result_count = 0
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'a' and ('data-ds-appid' in attrs or 'search_result_row' in (attrs.get('class') or '').split()):
+            self.result_count += 1
+        if tag == 'a' and 'data-ds-appid' in attrs:
+            app_id = attrs['data-ds-appid'] or ''
+            # Наборы перечисляют несколько appid через запятую - их пропускаем
+            self._row = {'id': app_id, 'title': ''} if app_id.isdigit() else None
+            return
+        if self._row is None:
+            return
+
+        if 'data-discount' in attrs:
+            self._row['discount'] = int(attrs['data-discount'] or 0)
+            if (attrs.get('data-price-final') or '').isdigit():
+                self._row['final_price_cents'] = int(attrs['data-price-final'])
+
+        for css_class in (attrs.get('class') or '').split():
+            if css_class in self._CAPTURE_CLASSES:
+                self._capture = self._CAPTURE_CLASSES[css_class]
+                self._row.setdefault(self._capture, '')
+
+    def handle_data(self, data):
+        if self._row is not None and self._capture:
+            self._row[self._capture] += data
+
+    def handle_endtag(self, tag):
+        self._capture = None
+        if tag == 'a' and self._row is not None:
+            self._rows.append(self._finish_row(self._row))
+            self._row = None
+
+    @staticmethod
+    def _finish_row(raw):
+        discount = raw.get('discount')
+        if 'final_price_cents' in raw:
+            final_price = _price_amount(raw['final_price_cents'] / 100)
+        else:
+            final_price = _parse_price_text(raw.get('final_text'))
+        original_price = _parse_price_text(raw.get('original_text'))
+        if original_price is None and discount == 0:
+            original_price = final_price
+        return {
+            'id': raw['id'],
+            'title': raw['title'].strip() or 'Неизвестно',
+            'discount': discount,
+            'original_price': original_price,
+            'final_price': final_price
+        }
+
+    def pop_rows(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+async def iter_steam_search_rows(params, headers=None, timeout=None, parser=None):
+    """Асинхронно выдает строки поиска Steam по мере загрузки страницы.
+
+    Свой parser передают, чтобы потом прочитать его result_count.
+    """
+    parser = parser or SteamSearchParser()
+    async with http_stream(
+        "https://store.steampowered.com/search/results/", params=params, headers=headers, timeout=timeout
+    ) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_text():
+            parser.feed(chunk)
+            for row in parser.pop_rows():
+                yield row
+    parser.close()
+    for row in parser.pop_rows():
+        yield row
+
+
+async def scan_steam_search(params, on_row, headers=None, should_stop=None, max_pages=STEAM_SCAN_MAX_PAGES,
+                            page_size=STEAM_SCAN_PAGE_SIZE, concurrency=STEAM_SCAN_CONCURRENCY,
+                            time_budget=STEAM_SCAN_TIME_BUDGET):
+    """Параллельно обходит страницы поиска Steam, передавая строки в on_row.
+
+    Каждая строка передается один раз (дубли между страницами отсекаются),
+    сразу по мере разбора страницы. Обход заканчивается, когда страница
+    вернула меньше page_size строк (список кончился), когда should_stop()
+    вернул True, или по истечении time_budget секунд. Возвращает число
+    просмотренных страниц.
+    """
+    seen_ids = set()
+    end_page = max_pages
+    next_page = 0
+    scanned_pages = 0
+
+    async def scan_page(page):
+        nonlocal end_page, scanned_pages
+        page_params = {**params, 'start': page * page_size, 'count': page_size}
+        parser = SteamSearchParser()
+        try:
+            async for row in iter_steam_search_rows(page_params, headers=headers, timeout=STEAM_SCAN_PAGE_TIMEOUT,
+                                                    parser=parser):
+                if row['id'] not in seen_ids:
+                    seen_ids.add(row['id'])
+                    on_row(row)
+        except httpx.HTTPError as e:
+            log.warning("⚠️ Поиск Steam, страница %s: %r", page + 1, e)
+            return
+        scanned_pages += 1
+        # Считаем все строки страницы, включая пропущенные парсером наборы
+        if parser.result_count < page_size:
+            end_page = min(end_page, page + 1)
+
+    async def worker():
+        nonlocal next_page
+        while next_page < end_page and not (should_stop and should_stop()):
+            page = next_page
+            next_page += 1
+            await scan_page(page)
+
+    try:
+        await asyncio.wait_for(asyncio.gather(*(worker() for _ in range(concurrency))), timeout=time_budget)
+    except asyncio.TimeoutError:
+        log.info("⏱️ Поиск Steam: бюджет %s сек исчерпан, просмотрено страниц: %s", time_budget, scanned_pages)
+
+    return scanned_pages
+
+
+async def _parse_steam_featured(data):
+    """Достает из api/featured временно бесплатные (100%) игры, исключая F2P"""
+    candidates = {}
+    for category in ['large_capsules', 'featured_win', 'featured_mac', 'featured_linux']:
+        if category in data:
+            for game in data[category]:
+                discount = game.get('discount_percent', 0)
+                if discount == 100:
+                    app_id = game.get('id')
+                    if app_id and str(app_id) not in candidates:
+                        candidates[str(app_id)] = game
+
+    free_games = []
+    f2p_flags = await check_games_free_to_play(list(candidates))
+    for app_id, game in candidates.items():
+        if not f2p_flags.get(app_id):
+            free_games.append({
+                'title': game.get('name', 'Неизвестно'),
+                'url': f"https://store.steampowered.com/app/{app_id}",
+                'id': app_id,
+                'platform': 'Steam'
+            })
+    return free_games
+
+
+async def check_steam_free_games(raise_errors=False):
+    """Ищет игры со 100% скидкой в Steam.
+
+    raise_errors=True пробрасывает ошибку, чтобы планировщик мог отложить повтор.
+    """
     free_games = []
     found_ids = set()
 
@@ -382,29 +1840,12 @@ def check_steam_free_games():
         }
 
         url = "https://store.steampowered.com/api/featured/"
-        response = requests.get(url, headers=headers, timeout=10)
+        featured, _ = await fetch_feed('steam_featured', url, _parse_steam_featured, headers=headers, timeout=10)
 
-        if response.status_code == 200:
-            data = response.json()
+        for game in featured or []:
+            found_ids.add(game['id'])
+            free_games.append(game)
 
-            for category in ['large_capsules', 'featured_win', 'featured_mac', 'featured_linux']:
-                if category in data:
-                    for game in data[category]:
-                        discount = game.get('discount_percent', 0)
-                        if discount == 100:
-                            app_id = game.get('id')
-                            if app_id and str(app_id) not in found_ids:
-                                is_f2p = is_game_free_to_play(app_id)
-                                if not is_f2p:
-                                    found_ids.add(str(app_id))
-                                    free_games.append({
-                                        'title': game.get('name', 'Неизвестно'),
-                                        'url': f"https://store.steampowered.com/app/{app_id}",
-                                        'id': str(app_id),
-                                        'platform': 'Steam'
-                                    })
-
-        search_url = "https://store.steampowered.com/search/results/"
         params = {
             'query': '',
             'start': 0,
@@ -414,31 +1855,49 @@ def check_steam_free_games():
             'ndl': 1
         }
 
-        response = requests.get(search_url, params=params, headers=headers, timeout=10)
-
-        if response.status_code == 200:
-            html = response.text
-            app_ids = re.findall(r'data-ds-appid="(\d+)"', html)
-
-            for app_id in app_ids[:10]:
-                if str(app_id) not in found_ids:
-                    details = get_game_details(app_id)
-                    if details and details.get('original_price', 0) > 0:
-                        found_ids.add(str(app_id))
-                        free_games.append({
-                            'title': details.get('name', 'Неизвестно'),
-                            'url': f"https://store.steampowered.com/app/{app_id}",
-                            'id': str(app_id),
-                            'platform': 'Steam'
-                        })
+        # Цена и скидка есть прямо в строках поиска, appdetails нужен только
+        # для строк без блока цены
+        unpriced_ids = []
+        async for row in iter_steam_search_rows(params, headers=headers, timeout=10):
+            app_id = row['id']
+            if app_id in found_ids:
+                continue
+            # Без исходной цены раздачу не отличить от бесплатной игры - уточняем через appdetails
+            if row['discount'] is None or (row['discount'] == 100 and not row['original_price']):
+                unpriced_ids.append(app_id)
+            elif row['discount'] == 100:
+                found_ids.add(app_id)
+                free_games.append({
+                    'title': row['title'],
+                    'url': f"https://store.steampowered.com/app/{app_id}",
+                    'id': app_id,
+                    'platform': 'Steam'
+                })
+
+        pending_ids = [app_id for app_id in unpriced_ids[:10] if app_id not in found_ids]
+        details_by_id = await get_games_details(pending_ids)
+
+        for app_id in pending_ids:
+            if app_id not in found_ids:
+                details = details_by_id.get(app_id)
+                if details and details.get('original_price', 0) > 0:
+                    found_ids.add(app_id)
+                    free_games.append({
+                        'title': details.get('name', 'Неизвестно'),
+                        'url': f"https://store.steampowered.com/app/{app_id}",
+                        'id': app_id,
+                        'platform': 'Steam'
+                    })
 
     except Exception as e:
-        print(f"❌ Ошибка при проверке Steam: {e}")
+        log.error("❌ Ошибка при проверке Steam: %s", e)
+        if raise_errors:
+            raise
 
     return free_games
 
 
-def check_steam_discounts():
+async def check_steam_discounts(raise_errors=False):
     """Проверяет игры со скидками в Steam (всегда ищет 80%+)"""
     discounted_games = []
     found_ids = set()
@@ -450,48 +1909,78 @@ def check_steam_discounts():
             'Accept-Language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7'
         }
 
-        print(f"\n🔍 ПРОВЕРКА СКИДОК STEAM (80%+)...")
+        log.info("🔍 ПРОВЕРКА СКИДОК STEAM (80%%+)...")
 
-        search_url = "https://store.steampowered.com/search/results/"
         params = {
             'query': '',
-            'start': 0,
-            'count': 100,
             'specials': 1,
             'ndl': 1,
             'sort_by': 'Price_DESC',
             'category1': 998,
             'os': 'win',
-            'discounts': 1
+            'discounts': 1,
+            'cc': 'ru'
         }
 
-        response = requests.get(search_url, params=params, headers=headers, timeout=15)
-
-        if response.status_code == 200:
-            html = response.text
-            app_ids = re.findall(r'data-ds-appid="(\d+)"', html)
-
-            for app_id in app_ids[:30]:
-                if str(app_id) not in found_ids:
-                    details = get_game_details(app_id)
-                    if details:
-                        discount = details.get('discount_percent', 0)
-                        if discount >= min_discount and discount < 100:
-                            found_ids.add(str(app_id))
-                            discounted_games.append({
-                                'title': details.get('name', 'Неизвестно'),
-                                'url': f"https://store.steampowered.com/app/{app_id}",
-                                'id': str(app_id),
-                                'discount': discount,
-                                'original_price': details.get('original_price', 0),
-                                'final_price': details.get('final_price', 0),
-                                'currency': details.get('currency', 'RUB'),
-                                'platform': 'Steam'
-                            })
-                            print(f"✅ Найдена скидка {discount}%: {details.get('name')}")
+        # Скидку и цены берем из строк поиска: строки с малой скидкой
+        # отбрасываются без запросов appdetails
+        unpriced_ids = []
+
+        def take_row(row):
+            app_id = row['id']
+            if app_id in found_ids:
+                return
+            discount = row['discount']
+            if discount is None:
+                unpriced_ids.append(app_id)
+            elif min_discount <= discount < 100:
+                found_ids.add(app_id)
+                discounted_games.append({
+                    'title': row['title'],
+                    'url': f"https://store.steampowered.com/app/{app_id}",
+                    'id': app_id,
+                    'discount': discount,
+                    'original_price': row['original_price'] or 0,
+                    'final_price': row['final_price'] or 0,
+                    'currency': 'RUB',
+                    'platform': 'Steam'
+                })
+                log.debug("✅ Найдена скидка %s%%: %s", discount, row['title'])
+
+        # Листаем до конца списка: по полному набору скидок видно, какие
+        # предложения закончились, а какие только выпали из первой десятки
+        pages = await scan_steam_search(
+            params,
+            take_row,
+            headers=headers,
+            max_pages=STEAM_SCAN_MAX_PAGES if STEAM_DEEP_SCAN else 1
+        )
+        log.info("📄 Просмотрено страниц поиска: %s", pages)
+
+        pending_ids = [app_id for app_id in unpriced_ids[:30] if app_id not in found_ids]
+        details_by_id = await get_games_details(pending_ids)
+
+        for app_id in pending_ids:
+            if app_id not in found_ids:
+                details = details_by_id.get(app_id)
+                if details:
+                    discount = details.get('discount_percent', 0)
+                    if discount >= min_discount and discount < 100:
+                        found_ids.add(app_id)
+                        discounted_games.append({
+                            'title': details.get('name', 'Неизвестно'),
+                            'url': f"https://store.steampowered.com/app/{app_id}",
+                            'id': app_id,
+                            'discount': discount,
+                            'original_price': details.get('original_price', 0),
+                            'final_price': details.get('final_price', 0),
+                            'currency': details.get('currency', 'RUB'),
+                            'platform': 'Steam'
+                        })
+                        log.debug("✅ Найдена скидка %s%%: %s", discount, details.get('name'))
 
         url = "https://store.steampowered.com/api/featuredcategories/"
-        response = requests.get(url, headers=headers, timeout=15)
+        response = await http_get(url, headers=headers, timeout=15)
 
         if response.status_code == 200:
             data = response.json()
@@ -522,9 +2011,11 @@ def check_steam_discounts():
                                     'currency': 'RUB',
                                     'platform': 'Steam'
                                 })
-                                print(f"✅ Найдена скидка {discount}%: {game.get('name')}")
+                                log.debug("✅ Найдена скидка %s%%: %s", discount, game.get('name'))
 
-        discounted_games.sort(key=lambda x: x['discount'], reverse=True)
+        # Страницы приходят в порядке загрузки, поэтому при равной скидке
+        # порядок задает appid - иначе верхушка менялась бы от цикла к циклу
+        discounted_games.sort(key=lambda x: (-x['discount'], int(x['id'])))
 
         unique_games = []
         seen_titles = set()
@@ -533,12 +2024,15 @@ def check_steam_discounts():
                 seen_titles.add(game['title'])
                 unique_games.append(game)
 
-        discounted_games = unique_games[:10]
+        # Весь список: рассылку ограничивает announce_limit источника, показ - show_limit
+        discounted_games = unique_games
 
-        print(f"\n📊 ВСЕГО НАЙДЕНО: {len(discounted_games)} игр со скидкой 80%+")
+        log.info("📊 ВСЕГО НАЙДЕНО: %s игр со скидкой 80%%+", len(discounted_games))
 
     except Exception as e:
-        print(f"❌ Ошибка при проверке скидок Steam: {e}")
+        log.error("❌ Ошибка при проверке скидок Steam: %s", e)
+        if raise_errors:
+            raise
 
     return discounted_games
 
@@ -547,7 +2041,100 @@ def check_steam_discounts():
 # EPIC GAMES ФУНКЦИИ
 # =============================================================================
 
-def check_epic_free_games():
+def _parse_epic_free_games(data):
+    """Достает из freeGamesPromotions игры, которые сейчас раздаются бесплатно"""
+    free_games = []
+
+    if 'data' in data and 'Catalog' in data['data']:
+        games = data['data']['Catalog']['searchStore']['elements']
+
+        for game in games:
+            promotions = game.get('promotions')
+            if promotions:
+                promo_offers = promotions.get('promotionalOffers')
+
+                if promo_offers and len(promo_offers) > 0:
+                    offers = promo_offers[0].get('promotionalOffers', [])
+
+                    if len(offers) > 0:
+                        price_info = game.get('price', {}).get('totalPrice', {})
+                        original_price = price_info.get('originalPrice', 0)
+                        current_price = price_info.get('discountPrice', 0)
+
+                        if original_price > 0 and current_price == 0:
+                            game_id = game.get('id')
+                            end_date = offers[0].get('endDate', '')
+
+                            free_games.append({
+                                'title': game.get('title', 'Неизвестно'),
+                                'url': f"https://store.epicgames.com/ru/free-games",
+                                'id': game_id,
+                                'platform': 'Epic Games',
+                                'end_date': end_date,
+                                'description': game.get('description', ''),
+                                'image': game.get('keyImages', [{}])[0].get('url', '') if game.get(
+                                    'keyImages') else ''
+                            })
+
+    return free_games
+
+
+def _parse_epic_date(value):
+    """Переводит дату Epic (ISO 8601) в unix time, None - если разобрать нельзя"""
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
+def _parse_epic_promotion_windows(data):
+    """Достает окна бесплатных раздач: текущие (promotionalOffers) и
+    будущие (upcomingPromotionalOffers).
+
+    Возвращает список словарей с ключами title, start, end (unix time) и
+    upcoming. Раздача - это скидка до 0% от цены.
+    """
+    windows = []
+    try:
+        games = data['data']['Catalog']['searchStore']['elements']
+    except (KeyError, TypeError):
+        return windows
+
+    for game in games:
+        promotions = game.get('promotions') or {}
+        for key, upcoming in (('promotionalOffers', False), ('upcomingPromotionalOffers', True)):
+            for group in promotions.get(key) or []:
+                for offer in group.get('promotionalOffers') or []:
+                    if (offer.get('discountSetting') or {}).get('discountPercentage') != 0:
+                        continue
+                    start = _parse_epic_date(offer.get('startDate'))
+                    end = _parse_epic_date(offer.get('endDate'))
+                    if start is None or end is None:
+                        continue
+                    windows.append({
+                        'title': game.get('title', 'Неизвестно'),
+                        'start': start,
+                        'end': end,
+                        'upcoming': upcoming
+                    })
+
+    windows.sort(key=lambda window: window['start'])
+    return windows
+
+
+def _parse_epic_feed(data):
+    """Разбирает freeGamesPromotions: текущие раздачи и окна всех раздач"""
+    return {
+        'games': _parse_epic_free_games(data),
+        'windows': _parse_epic_promotion_windows(data)
+    }
+
+
+# Окна раздач из последней загруженной ленты Epic (по ним планируются перепроверки)
+epic_promotion_windows = ()
+
+
+async def check_epic_free_games(raise_errors=False):
     """Ищет бесплатные игры в Epic Games Store"""
     free_games = []
 
@@ -563,44 +2150,20 @@ def check_epic_free_games():
             'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
         }
 
-        response = requests.get(url, params=params, headers=headers, timeout=10)
-
-        if response.status_code == 200:
-            data = response.json()
+        feed, _ = await fetch_feed(
+            'epic_free_games', url, _parse_epic_feed, params=params, headers=headers, timeout=10
+        )
+        if feed is None:
+            raise RuntimeError("лента freeGamesPromotions недоступна")
 
-            if 'data' in data and 'Catalog' in data['data']:
-                games = data['data']['Catalog']['searchStore']['elements']
-
-                for game in games:
-                    promotions = game.get('promotions')
-                    if promotions:
-                        promo_offers = promotions.get('promotionalOffers')
-
-                        if promo_offers and len(promo_offers) > 0:
-                            offers = promo_offers[0].get('promotionalOffers', [])
-
-                            if len(offers) > 0:
-                                price_info = game.get('price', {}).get('totalPrice', {})
-                                original_price = price_info.get('originalPrice', 0)
-                                current_price = price_info.get('discountPrice', 0)
-
-                                if original_price > 0 and current_price == 0:
-                                    game_id = game.get('id')
-                                    end_date = offers[0].get('endDate', '')
-
-                                    free_games.append({
-                                        'title': game.get('title', 'Неизвестно'),
-                                        'url': f"https://store.epicgames.com/ru/free-games",
-                                        'id': game_id,
-                                        'platform': 'Epic Games',
-                                        'end_date': end_date,
-                                        'description': game.get('description', ''),
-                                        'image': game.get('keyImages', [{}])[0].get('url', '') if game.get(
-                                            'keyImages') else ''
-                                    })
+        global epic_promotion_windows
+        epic_promotion_windows = tuple(feed['windows'])
+        free_games = list(feed['games'])
 
     except Exception as e:
-        print(f"❌ Ошибка при проверке Epic Games: {e}")
+        log.error("❌ Ошибка при проверке Epic Games: %s", e)
+        if raise_errors:
+            raise
 
     return free_games
 
@@ -616,16 +2179,363 @@ def format_epic_end_date(end_date):
     return 'Неизвестно'
 
 
+# =============================================================================
+# ИСТОЧНИКИ ПРЕДЛОЖЕНИЙ
+# =============================================================================
+
+class StoreSource:
+    """Источник предложений: как его парсить, как сверять результаты и как часто опрашивать.
+
+    fetch - корутина без аргументов, возвращает список игр и бросает
+    исключение при ошибке. Игры сверяются с notified_games на платформе namespace по
+    dedup_key(game) и рассылаются как game_type. Если задан next_wakeup, он
+    после успешного опроса называет момент (unix time), когда источник стоит
+    перепроверить раньше обычного интервала. Если задан announce_limit,
+    рассылаются только первые announce_limit игр списка, а остальные нужны,
+    чтобы не считать закончившимися предложения, выпавшие из этой верхушки.
+    """
+
+    def __init__(self, name, fetch, namespace, game_type, interval, icon, title, heading,
+                 empty_text=None, show_limit=None, dedup_key=None, feed=None, next_wakeup=None,
+                 jitter=SOURCE_JITTER, announce_limit=None):
+        self.name = name
+        self.fetch = fetch
+        self.namespace = namespace
+        self.game_type = game_type
+        self.interval = interval
+        self.icon = icon
+        self.title = title
+        self.heading = heading
+        self.empty_text = empty_text
+        self.show_limit = show_limit
+        self.dedup_key = dedup_key or (lambda game: game['id'])
+        self.feed = feed
+        self.next_wakeup = next_wakeup
+        self.jitter = jitter
+        self.announce_limit = announce_limit
+        self.failures = 0
+
+    def next_delay(self, games=None):
+        """Через сколько секунд опросить источник снова.
+
+        После ошибок пауза растет экспоненциально, но не дольше обычного
+        интервала. Интервал размывается на +-jitter, чтобы источники не
+        совпадали по времени.
+        """
+        if self.failures:
+            return min(SOURCE_RETRY_DELAY * 2 ** (self.failures - 1), self.interval)
+
+        delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+        if self.next_wakeup is not None:
+            wakeup = self.next_wakeup()
+            if wakeup is not None:
+                delay = min(delay, max(wakeup - time.time(), 0))
+        return delay
+
+
+# Реестр источников. Порядок регистрации - порядок показа в /start и /testparse
+STORE_SOURCES = {}
+
+
+def register_source(source):
+    """Добавляет источник в реестр"""
+    STORE_SOURCES[source.name] = source
+    return source
+
+
+def epic_next_wakeup():
+    """Момент перепроверки Epic: сразу после ближайшей границы окна раздачи.
+
+    Для текущей раздачи граница - ее конец, для будущей - начало. Если
+    граница уже прошла, а лента все еще старая (CDN Epic обновляется с
+    задержкой), перепроверяем через SOURCE_RETRY_DELAY.
+    """
+    now = time.time()
+    wakeups = []
+    for window in epic_promotion_windows:
+        boundary = window['start'] if window['upcoming'] else window['end']
+        if boundary + EPIC_WAKEUP_GRACE > now:
+            wakeups.append(boundary + EPIC_WAKEUP_GRACE)
+        elif now - boundary < EPIC_CHECK_INTERVAL:
+            wakeups.append(now + SOURCE_RETRY_DELAY)
+    return min(wakeups, default=None)
+
+
+register_source(StoreSource(
+    'steam_free',
+    lambda: check_steam_free_games(raise_errors=True),
+    namespace='steam',
+    game_type='free',
+    interval=STEAM_FREE_CHECK_INTERVAL,
+    icon='🎮',
+    title='Steam бесплатные',
+    heading='🎯 <b>Бесплатные игры в Steam:</b>',
+    empty_text='ℹ️ В Steam сейчас нет временно бесплатных игр.',
+    show_limit=5
+))
+
+register_source(StoreSource(
+    'epic',
+    lambda: check_epic_free_games(raise_errors=True),
+    namespace='epic',
+    game_type='free',
+    interval=EPIC_CHECK_INTERVAL,
+    icon='🎯',
+    title='Epic бесплатные',
+    heading='🎯 <b>Бесплатные игры в Epic Games Store:</b>',
+    empty_text='ℹ️ В Epic Games Store сейчас нет бесплатных игр.',
+    feed='epic_free_games',
+    next_wakeup=epic_next_wakeup
+))
+
+register_source(StoreSource(
+    'discounts',
+    lambda: check_steam_discounts(raise_errors=True),
+    namespace='steam',
+    game_type='discount',
+    interval=STEAM_DISCOUNTS_CHECK_INTERVAL,
+    icon='🔥',
+    title='Скидки 80%+',
+    heading='🔥 <b>Огромные скидки в Steam (80%+):</b>',
+    show_limit=5,
+    dedup_key=lambda game: f"discount_{game['id']}",
+    announce_limit=10
+))
+
+
+# =============================================================================
+# СОСТОЯНИЕ ПРЕДЛОЖЕНИЙ
+# =============================================================================
+
+class DealStateStore:
+    """Последнее наблюдаемое состояние каждого предложения: скидка, цена,
+    окончание и активно ли оно сейчас.
+
+    diff() сравнивает свежий список источника с сохраненным состоянием и
+    возвращает только изменения (new, deepened, ended, returned). В базу
+    пишутся лишь изменившиеся строки, неизменные предложения не трогаются.
+    Закончившиеся ищутся по множеству активных id источника, а не по всем
+    состояниям, которые хранятся еще DEAL_STATE_RETENTION.
+    """
+
+    def __init__(self):
+        self._states = None
+        self._active = {}
+
+    def load(self):
+        """Загружает состояние из базы при первом обращении"""
+        if self._states is None:
+            self._states = {}
+            rows = get_db().execute(
+                "SELECT source, game_id, discount, final_price, end_date, active, first_seen, changed_at "
+                "FROM deal_state"
+            ).fetchall()
+            for source, game_id, discount, final_price, end_date, active, first_seen, changed_at in rows:
+                self._states.setdefault(source, {})[game_id] = {
+                    'discount': discount,
+                    'final_price': final_price,
+                    'end_date': end_date,
+                    'active': bool(active),
+                    'first_seen': first_seen,
+                    'changed_at': changed_at
+                }
+                if active:
+                    self._active.setdefault(source, set()).add(game_id)
+        return self._states
+
+    def diff(self, source, games, present_ids=None):
+        """Сверяет список игр источника с прошлым состоянием.
+
+        Возвращает список (kind, game_id, game, previous): kind - new, deepened,
+        ended или returned; game равен None для ended; previous - прошлое
+        состояние или None для new. Изменения без события (например, скидка
+        уменьшилась) только обновляют состояние. present_ids - id всех
+        предложений, которые еще действуют, если games - только их часть;
+        закончившимися считаются активные id не из present_ids.
+        """
+        states = self.load().setdefault(source.name, {})
+        active = self._active.get(source.name, set())
+        now = time.time()
+        changes = []
+        dirty = {}
+        observed = set()
+
+        for game in games:
+            game_id = str(source.dedup_key(game))
+            if game_id in observed:
+                continue
+            observed.add(game_id)
+
+            discount = game.get('discount', 100 if source.game_type == 'free' else None)
+            final_price = game.get('final_price')
+            end_date = game.get('end_date') or None
+            previous = states.get(game_id)
+
+            if previous is None:
+                kind = 'new'
+            elif not previous['active']:
+                kind = 'returned' if now - previous['changed_at'] >= DEAL_RETURN_COOLDOWN else None
+            elif (discount, final_price, end_date) == (
+                    previous['discount'], previous['final_price'], previous['end_date']):
+                continue
+            elif discount is not None and previous['discount'] is not None and discount > previous['discount']:
+                kind = 'deepened'
+            else:
+                kind = None
+
+            dirty[game_id] = {
+                'discount': discount,
+                'final_price': final_price,
+                'end_date': end_date,
+                'active': True,
+                'first_seen': previous['first_seen'] if previous else now,
+                'changed_at': now
+            }
+            if kind is not None:
+                changes.append((kind, game_id, game, previous))
+
+        present = observed if present_ids is None else observed | present_ids
+        for game_id in active - present:
+            state = states[game_id]
+            dirty[game_id] = dict(state, active=False, changed_at=now)
+            changes.append(('ended', game_id, None, state))
+        # Активны все увиденные и те прежние, что еще действуют
+        self._active[source.name] = observed | (active & present)
+
+        if dirty:
+            states.update(dirty)
+            self._save(source.name, dirty)
+        return changes
+
+    def _save(self, source_name, states):
+        with DB_WRITE_SECONDS.time('deal_state'), get_db() as db:
+            db.executemany(
+                "INSERT OR REPLACE INTO deal_state "
+                "(source, game_id, discount, final_price, end_date, active, first_seen, changed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (source_name, game_id, state['discount'], state['final_price'], state['end_date'],
+                     int(state['active']), state['first_seen'], state['changed_at'])
+                    for game_id, state in states.items()
+                ]
+            )
+
+    def prune(self, max_age=DEAL_STATE_RETENTION):
+        """Забывает предложения, закончившиеся более max_age секунд назад"""
+        cutoff = time.time() - max_age
+        stale = [
+            (source_name, game_id)
+            for source_name, states in self.load().items()
+            for game_id, state in states.items()
+            if not state['active'] and state['changed_at'] < cutoff
+        ]
+        if stale:
+            for source_name, game_id in stale:
+                del self._states[source_name][game_id]
+            with get_db() as db:
+                db.executemany("DELETE FROM deal_state WHERE source = ? AND game_id = ?", stale)
+        return len(stale)
+
+
+deal_states = DealStateStore()
+
+
+# =============================================================================
+# СНИМОК ТЕКУЩИХ ПРЕДЛОЖЕНИЙ
+# =============================================================================
+
+# Последний опубликованный снимок: списки игр по имени источника. Заменяется
+# целиком, поэтому читатели всегда видят согласованный набор одной версии.
+deals_snapshot = {
+    'version': 0,
+    'updated_at': 0,
+    'deals': {}
+}
+
+_deals_refresh_task = None
+
+
+def publish_deals(updates):
+    """Публикует новую версию снимка, заменяя списки обновленных источников"""
+    global deals_snapshot
+    deals = dict(deals_snapshot['deals'])
+    for name, games in updates.items():
+        deals[name] = tuple(games)
+    deals_snapshot = {
+        'version': deals_snapshot['version'] + 1,
+        'updated_at': time.time(),
+        'deals': deals
+    }
+    return deals_snapshot
+
+
+async def _refresh_deals_snapshot():
+    """Запускает парсеры всех источников и публикует результат как новый снимок.
+
+    Источник с ошибкой сохраняет свой прошлый список, если он есть.
+    """
+    sources = list(STORE_SOURCES.values())
+    results = await asyncio.gather(*(source.fetch() for source in sources), return_exceptions=True)
+    updates = {}
+    for source, games in zip(sources, results):
+        if isinstance(games, BaseException):
+            log.error("❌ Ошибка источника %s: %s", source.name, games)
+            if source.name in deals_snapshot['deals']:
+                continue
+            games = []
+        updates[source.name] = games
+    return publish_deals(updates)
+
+
+def begin_deals_refresh():
+    """Отмечает, что снимок уже обновляется извне (циклом проверки).
+
+    Пока возвращенный future не завершен, get_deals_snapshot ждет его, а не
+    запускает свои парсеры. Возвращает None, если обновление уже идет.
+    """
+    global _deals_refresh_task
+    if _deals_refresh_task is not None and not _deals_refresh_task.done():
+        return None
+    _deals_refresh_task = asyncio.get_running_loop().create_future()
+    return _deals_refresh_task
+
+
+async def get_deals_snapshot(max_age=DEALS_SNAPSHOT_TTL):
+    """Возвращает снимок предложений, обновляя его, если он старше max_age.
+
+    Одновременные запросы к устаревшему снимку ждут одно общее обновление,
+    а не запускают каждый свои парсеры.
+    """
+    global _deals_refresh_task
+    complete = STORE_SOURCES.keys() <= deals_snapshot['deals'].keys()
+    if complete and time.time() - deals_snapshot['updated_at'] < max_age:
+        return deals_snapshot
+
+    if _deals_refresh_task is None or _deals_refresh_task.done():
+        _deals_refresh_task = asyncio.ensure_future(_refresh_deals_snapshot())
+    return await asyncio.shield(_deals_refresh_task)
+
+
 # =============================================================================
 # ФОРМАТИРОВАНИЕ СООБЩЕНИЙ
 # =============================================================================
 
+def format_change_header(change, previous=None):
+    """Заголовок для уведомления о предложении, которое изменилось или вернулось"""
+    if change == 'deepened' and previous and previous.get('discount') is not None:
+        return f"📉 <b>Скидка выросла!</b> Было -{previous['discount']}%\n\n"
+    if change == 'returned':
+        return "🔁 <b>Предложение снова доступно!</b>\n\n"
+    return ""
+
+
 def format_game_message(game, game_type='free'):
     """Форматирует сообщение об игре"""
+    title = html.escape(game['title'])
     if game['platform'] == 'Steam':
         if game_type == 'free':
             return (
-                f"🎮 <b>{game['title']}</b>\n"
+                f"🎮 <b>{title}</b>\n"
                 f"━━━━━━━━━━━━━━━━━━━━━\n"
                 f"💰 <b>Цена:</b> <s>Обычная</s> → <b>БЕСПЛАТНО!</b>\n"
                 f"🎯 <b>Тип:</b> Временная акция\n"
@@ -634,7 +2544,7 @@ def format_game_message(game, game_type='free'):
             )
         else:
             return (
-                f"🔥 <b>{game['title']}</b>\n"
+                f"🔥 <b>{title}</b>\n"
                 f"━━━━━━━━━━━━━━━━━━━━━\n"
                 f"💰 <b>Цена:</b> <s>{game['original_price']} ₽</s>\n"
                 f"💎 <b>Сейчас:</b> <b>{game['final_price']} ₽</b> (-{game['discount']}%)\n"
@@ -644,7 +2554,7 @@ def format_game_message(game, game_type='free'):
     else:
         end_date = format_epic_end_date(game.get('end_date', ''))
         return (
-            f"🎮 <b>{game['title']}</b>\n"
+            f"🎮 <b>{title}</b>\n"
             f"━━━━━━━━━━━━━━━━━━━━━\n"
             f"💰 <b>Цена:</b> <s>999 ₽</s> → <b>БЕСПЛАТНО!</b>\n"
             f"📅 <b>До:</b> {end_date}\n"
@@ -653,6 +2563,167 @@ def format_game_message(game, game_type='free'):
         )
 
 
+def format_digest_line(game, game_type, change=None):
+    """Короткое описание предложения для дайджеста"""
+    if game_type == 'free':
+        icon = '🎮'
+        price = "<b>БЕСПЛАТНО!</b>"
+        if game.get('end_date'):
+            price += f" до {format_epic_end_date(game['end_date'])}"
+    else:
+        icon = '🔥'
+        price = f"<s>{game['original_price']} ₽</s> → <b>{game['final_price']} ₽</b> (-{game['discount']}%)"
+    mark = {'deepened': '📉 ', 'returned': '🔁 '}.get(change, '')
+    return (
+        f"{mark}{icon} <b>{html.escape(game['title'])}</b> ({game['platform']})\n"
+        f"💰 {price}\n"
+        f"🔗 {game['url']}"
+    )
+
+
+def format_digest_message(items):
+    """Форматирует дайджест из нескольких предложений одним сообщением"""
+    lines = [
+        f"📬 <b>Новые предложения: {len(items)}</b>\n"
+        f"━━━━━━━━━━━━━━━━━━━━━"
+    ]
+    for item in items:
+        lines.append(format_digest_line(item['game'], item['game_type'], item.get('change')))
+    return "\n\n".join(lines)
+
+
+# Готовые параметры send_message по ключу (игра, тип, версия цены, язык, заголовок изменения)
+_rendered_messages = OrderedDict()
+render_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _game_price_version(game):
+    """Версия цены предложения: меняется вместе со скидкой, ценой или сроком"""
+    return (game.get('discount'), game.get('original_price'), game.get('final_price'), game.get('end_date'))
+
+
+def render_game_message(game, game_type='free', language='ru', change=None, previous=None):
+    """Возвращает неизменяемые параметры send_message для сообщения об игре.
+
+    Сообщение одинаково для всех пользователей с одним языком, поэтому оно
+    рендерится один раз и берется из кэша и рассылкой, и /start. Версия
+    цены входит в ключ: изменившееся предложение рендерится заново, а
+    старая запись вытесняется по LRU. Пока все тексты на русском, language
+    только разделяет кэш.
+    """
+    # В ключ входит сам заголовок: для new и для показа без изменения он пуст,
+    # и рассылка с /start делят одну запись
+    header = format_change_header(change, previous)
+    key = (game['platform'], str(game['id']), game_type, _game_price_version(game), language, header)
+    rendered = _rendered_messages.get(key)
+    if rendered is not None:
+        _rendered_messages.move_to_end(key)
+        render_cache_stats['hits'] += 1
+        return rendered
+
+    render_cache_stats['misses'] += 1
+    rendered = MappingProxyType({
+        'text': header + format_game_message(game, game_type),
+        'parse_mode': 'HTML',
+        'disable_web_page_preview': False
+    })
+    _rendered_messages[key] = rendered
+    if len(_rendered_messages) > RENDER_CACHE_SIZE:
+        _rendered_messages.popitem(last=False)
+    return rendered
+
+
+def format_render_cache_stats():
+    """Краткая статистика кэша готовых сообщений"""
+    return (f"{len(_rendered_messages)} сообщений, попаданий {render_cache_stats['hits']}, "
+            f"промахов {render_cache_stats['misses']}")
+
+
+# =============================================================================
+# ОБРАБОТКА ОБНОВЛЕНИЙ
+# =============================================================================
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления параллельно, но по порядку внутри одного чата.
+
+    Сначала обновление ждет замок своего чата и только потом занимает один из
+    max_concurrent слотов: очередь нажатий одного пользователя не отнимает
+    слоты у других чатов, а UPDATE_SECONDS не учитывает ожидание. Поэтому
+    лимит держит свой семафор, а BaseUpdateProcessor получает заведомо
+    большой лимит, который не срабатывает.
+    """
+
+    def __init__(self, max_concurrent):
+        super().__init__(2 ** 31 - 1)
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self._run_in_slot(coroutine)
+            return
+
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run_in_slot(coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+    async def _run_in_slot(self, coroutine):
+        async with self._slots:
+            with UPDATE_SECONDS.time():
+                await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+class ChatTaskRunner:
+    """Долгие фоновые задачи пользователей (например, показ текущих предложений).
+
+    Задачи одного чата выполняются строго по очереди, задачи разных чатов -
+    параллельно, но не больше limit одновременно. Обработчик команды только
+    ставит задачу и сразу освобождается для других обновлений. Задачи
+    создаются через application.create_task, поэтому app.stop() их дожидается.
+    """
+
+    def __init__(self, limit):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._tails = {}
+
+    def submit(self, application, chat_id, func, *args):
+        """Ставит func(*args) в очередь чата chat_id"""
+        previous = self._tails.get(chat_id)
+        task = application.create_task(self._run(previous, func, args))
+        self._tails[chat_id] = task
+        task.add_done_callback(lambda done: self._forget(chat_id, done))
+        return task
+
+    def _forget(self, chat_id, task):
+        if self._tails.get(chat_id) is task:
+            del self._tails[chat_id]
+
+    async def _run(self, previous, func, args):
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with self._semaphore:
+            try:
+                await func(*args)
+            except Exception as e:
+                log.error("❌ Ошибка фоновой задачи %s: %s", func.__name__, e)
+
+
+user_tasks = ChatTaskRunner(USER_TASK_CONCURRENCY)
+
+
 # =============================================================================
 # TELEGRAM - КОМАНДЫ
 # =============================================================================
@@ -683,11 +2754,18 @@ async def cmd_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     message_text = ' '.join(context.args)
 
-    status_msg = await update.message.reply_text("📨 Начинаю рассылку...")
+    job_id = enqueue_text_broadcast(message_text)
+    status_msg = await update.message.reply_text(f"📨 Рассылка #{job_id} поставлена в очередь...")
 
-    success = await broadcast_message(context.bot, message_text)
+    async def report_progress(stats, total):
+        await status_msg.edit_text(f"📨 Рассылка #{job_id}: {format_broadcast_progress(stats, total)}")
 
-    await status_msg.edit_text(f"✅ Рассылка завершена!\nОтправлено: {success} пользователям")
+    async def report_result():
+        summary = await wait_broadcast_job(job_id, on_progress=report_progress)
+        await status_msg.edit_text(f"✅ Рассылка #{job_id} завершена!\nОтправлено: {summary['sent']} пользователям")
+
+    # Не держим обработчик команды, пока идет рассылка
+    context.application.create_task(report_result())
 
 
 async def cmd_test_parsing(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -699,63 +2777,72 @@ async def cmd_test_parsing(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     status_msg = await update.message.reply_text("🔍 Проверяю парсинг...")
 
-    steam_free = check_steam_free_games()
-    epic_games = check_epic_free_games()
-    discounts = check_steam_discounts()
+    # /testparse fresh - принудительно перепарсить магазины
+    force = bool(context.args) and context.args[0] == 'fresh'
+    snapshot = await get_deals_snapshot(max_age=0 if force else DEALS_SNAPSHOT_TTL)
+    deals = snapshot['deals']
+    age_minutes = int(time.time() - snapshot['updated_at']) // 60
 
     msg = (
-        f"📊 <b>Результаты парсинга:</b>\n\n"
-        f"🎮 Steam бесплатные: {len(steam_free)}\n"
-        f"🎯 Epic бесплатные: {len(epic_games)}\n"
-        f"🔥 Скидки 80%+: {len(discounts)}"
+        f"📊 <b>Результаты парсинга:</b>\n"
+        f"🗂 Снимок v{snapshot['version']}, обновлен {age_minutes} мин. назад\n\n"
     )
-
-    if steam_free:
-        msg += "\n\n📋 Примеры бесплатных игр в Steam:\n"
-        for game in steam_free[:3]:
-            msg += f"• {game['title']}\n"
-
-    if epic_games:
-        msg += "\n📋 Бесплатные игры в Epic:\n"
-        for game in epic_games[:3]:
-            msg += f"• {game['title']}\n"
-
-    if discounts:
-        msg += "\n📋 Примеры скидок:\n"
-        for game in discounts[:3]:
-            msg += f"• {game['title']} -{game['discount']}%\n"
+    for source in STORE_SOURCES.values():
+        msg += f"{source.icon} {source.title}: {len(deals.get(source.name, ()))}\n"
+    msg += f"📦 Кэш appdetails: {appdetails_cache.format_stats()}\n"
+    msg += f"🧾 Кэш сообщений: {format_render_cache_stats()}\n"
+
+    for source in STORE_SOURCES.values():
+        games = deals.get(source.name, ())
+        if games:
+            msg += f"\n📋 {source.title}:\n"
+            for game in games[:3]:
+                if 'discount' in game:
+                    msg += f"• {html.escape(game['title'])} -{game['discount']}%\n"
+                else:
+                    msg += f"• {html.escape(game['title'])}\n"
 
     await status_msg.edit_text(msg, parse_mode='HTML')
 
 
-async def broadcast_message(bot, text, parse_mode='HTML'):
-    """Отправляет сообщение всем подписанным пользователям"""
-    users = load_users()
-    success_count = 0
-    failed_users = []
-
-    for user_id in users["users"]:
-        try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=text,
-                parse_mode=parse_mode,
-                disable_web_page_preview=False
-            )
-            success_count += 1
-            await asyncio.sleep(0.05)
-        except TelegramError as e:
-            print(f"⚠️ Ошибка отправки {user_id}: {e}")
-            if "Forbidden" in str(e) or "blocked" in str(e).lower():
-                failed_users.append(user_id)
+def format_stats_message():
+    """Сводка метрик для /stats"""
+    uptime_hours = (time.time() - PROCESS_STARTED_AT) / 3600
+    msg = (
+        f"📈 <b>Статистика бота</b>\n\n"
+        f"⏱ Работает: {uptime_hours:.1f} ч\n"
+        f"👥 Подписчиков: {SUBSCRIBERS.get()}\n"
+        f"📮 Заданий рассылки в очереди: {BROADCAST_JOBS_OPEN.get()}\n\n"
+        f"📨 Сообщений: отправлено {TELEGRAM_MESSAGES.get('sent')}, "
+        f"ошибок {TELEGRAM_MESSAGES.get('failed')}, заблокировали {TELEGRAM_MESSAGES.get('blocked')}\n"
+        f"⏳ RetryAfter: {TELEGRAM_RETRY_AFTER.get()}\n"
+        f"🚀 Скорость последней рассылки: {BROADCAST_RATE.get()} сообщ/сек\n\n"
+        f"🛒 <b>Источники:</b>\n"
+    )
+    for source in STORE_SOURCES.values():
+        count, total = SOURCE_FETCH_SECONDS.summary(source.name)
+        average = total / count if count else 0
+        msg += (f"• {source.title}: успешно {SOURCE_FETCHES.get(source.name, 'ok')}, "
+                f"ошибок {SOURCE_FETCHES.get(source.name, 'error')}, в среднем {average:.1f} сек\n")
+
+    msg += "\n💾 <b>Запись в базу:</b>\n"
+    for (op,) in list(DB_WRITE_SECONDS.values()):
+        count, total = DB_WRITE_SECONDS.summary(op)
+        msg += f"• {op}: {count} раз, в среднем {total / count * 1000:.1f} мс\n"
+
+    msg += (
+        f"\n📦 Кэш appdetails: {appdetails_cache.format_stats()}\n"
+        f"🧾 Кэш сообщений: {format_render_cache_stats()}\n"
+        f"🔎 Кэш подписок: попаданий {membership_cache.hits}, промахов {membership_cache.misses}"
+    )
+    return msg
 
-    if failed_users:
-        for user_id in failed_users:
-            remove_user(user_id)
-        print(f"🧹 Удалено {len(failed_users)} пользователей, заблокировавших бота")
 
-    print(f"✅ Сообщение отправлено {success_count}/{len(users['users'])} пользователям")
-    return success_count
+async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /stats - метрики бота (только для админа)"""
+    if update.effective_chat.id != YOUR_ADMIN_ID:
+        return
+    await update.message.reply_text(format_stats_message(), parse_mode='HTML')
 
 
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -764,16 +2851,15 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
 
     # Проверяем, уже подписан ли пользователь на рассылку
-    users = load_users()
-    if chat_id in users["users"]:
+    if is_user_subscribed(chat_id):
         # Если уже подписан, показываем текущие предложения
         await update.message.reply_text(
             "✅ Вы уже подписаны на рассылку!\n\n"
             "⏳ <i>Загружаю текущие предложения...</i>",
             parse_mode='HTML'
         )
-        await asyncio.sleep(1)
-        await show_current_deals(update, context)
+        # Показ предложений долгий - уводим его в фон, чтобы не держать обработку обновлений
+        user_tasks.submit(context.application, chat_id, show_current_deals, update, context)
         return
 
     # Создаем URL для подписки на канал
@@ -840,9 +2926,8 @@ async def check_subscription_callback(update: Update, context: ContextTypes.DEFA
             parse_mode='HTML'
         )
 
-        # Показываем текущие раздачи
-        await asyncio.sleep(1)
-        await show_current_deals(update, context)
+        # Показываем текущие раздачи в фоне
+        user_tasks.submit(context.application, chat_id, show_current_deals, update, context)
     else:
         # Если не подписан, показываем сообщение об ошибке с диагностикой
         channel_url = f"https://t.me/{MAIN_CHANNEL_ID.replace('@', '')}" if MAIN_CHANNEL_ID.startswith(
@@ -917,140 +3002,554 @@ async def show_current_deals(update: Update, context: ContextTypes.DEFAULT_TYPE)
     else:
         send_func = update.message.reply_text
 
-    await send_func("🎮 <b>Проверяю Steam...</b>", parse_mode='HTML')
-
-    # Проверяем Steam бесплатные
-    steam_free = check_steam_free_games()
-    print(f"🔍 Найдено бесплатных игр в Steam: {len(steam_free)}")
-
-    if steam_free:
-        found_any = True
+    language = get_user_setting(update.effective_chat.id, 'language', USER_SETTING_DEFAULTS['language'])
+
+    # Берем готовый снимок, который публикует проверщик игр
+    snapshot = await get_deals_snapshot()
+    deals = snapshot['deals']
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("🔍 Снимок v%s: %s", snapshot['version'],
+                  ", ".join(f"{name} {len(games)}" for name, games in deals.items()))
+
+    for source in STORE_SOURCES.values():
+        games = deals.get(source.name, ())
+        if games:
+            found_any = True
+            await send_func(source.heading, parse_mode='HTML')
+
+            for game in games[:source.show_limit]:
+                await send_func(**render_game_message(game, source.game_type, language))
+                sent_count += 1
+                await asyncio.sleep(0.5)
+        elif source.empty_text:
+            await send_func(source.empty_text, parse_mode='HTML')
+
+    if found_any:
         await send_func(
-            "🎯 <b>Бесплатные игры в Steam:</b>",
+            f"✅ <b>Готово!</b> Найдено предложений: {sent_count}\n\n"
+            f"📬 Я буду присылать новые раздачи автоматически!",
             parse_mode='HTML'
         )
-
-        for game in steam_free[:5]:
-            await send_func(
-                format_game_message(game, 'free'),
-                parse_mode='HTML',
-                disable_web_page_preview=False
-            )
-            sent_count += 1
-            await asyncio.sleep(0.5)
     else:
         await send_func(
-            "ℹ️ В Steam сейчас нет временно бесплатных игр.",
+            f"😔 <b>К сожалению, сейчас нет активных раздач.</b>\n\n"
+            f"📬 Как только появится новая бесплатная игра, я сразу тебе напишу.",
             parse_mode='HTML'
         )
 
-    # Проверяем Epic Games
-    await send_func("🎮 <b>Проверяю Epic Games Store...</b>", parse_mode='HTML')
-    epic_games = check_epic_free_games()
-    print(f"🔍 Найдено бесплатных игр в Epic: {len(epic_games)}")
 
-    if epic_games:
-        found_any = True
-        await send_func(
-            "🎯 <b>Бесплатные игры в Epic Games Store:</b>",
-            parse_mode='HTML'
-        )
+# =============================================================================
+# ДВИЖОК РАССЫЛКИ
+# =============================================================================
+
+# Общий бюджет отправки для всех рассылок бота (лимит Telegram ~30 сообщений/сек)
+telegram_rate_limiter = AsyncTokenBucket(BROADCAST_GLOBAL_RATE, BROADCAST_GLOBAL_RATE)
+
+# Время последней отправки в каждый чат (для лимита 1 сообщение/сек на чат)
+_chat_last_sent = {}
+
+
+async def _wait_chat_slot(chat_id):
+    """Ждет, пока в чат снова можно писать, не нарушая лимит на чат"""
+    now = time.monotonic()
+    last = _chat_last_sent.get(chat_id)
+    if last is not None and now - last < BROADCAST_PER_CHAT_INTERVAL:
+        await asyncio.sleep(BROADCAST_PER_CHAT_INTERVAL - (now - last))
+    _chat_last_sent[chat_id] = time.monotonic()
+
+    if len(_chat_last_sent) > 50000:
+        threshold = time.monotonic() - BROADCAST_PER_CHAT_INTERVAL
+        for stale_id in [cid for cid, sent_at in _chat_last_sent.items() if sent_at < threshold]:
+            del _chat_last_sent[stale_id]
+
+
+def _retry_after_seconds(retry_after):
+    """RetryAfter.retry_after бывает int или timedelta в разных версиях библиотеки"""
+    if hasattr(retry_after, 'total_seconds'):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+async def _send_with_retry(bot, chat_id, send_kwargs, stats):
+    """Отправляет одно сообщение с учетом лимитов и повторами после RetryAfter.
+
+    Возвращает итог для получателя: 'sent', 'blocked' или 'failed'.
+    """
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await telegram_rate_limiter.acquire()
+        await _wait_chat_slot(chat_id)
+        started = time.perf_counter()
+        try:
+            await bot.send_message(chat_id=chat_id, **send_kwargs)
+            TELEGRAM_SEND_SECONDS.observe(time.perf_counter() - started)
+            TELEGRAM_MESSAGES.inc('sent')
+            stats['sent'] += 1
+            return 'sent'
+        except RetryAfter as e:
+            # Telegram просит подождать - приостанавливаем всех отправителей сразу
+            TELEGRAM_RETRY_AFTER.inc()
+            stats['retry_after'] += 1
+            telegram_rate_limiter.pause(_retry_after_seconds(e.retry_after) + 0.5)
+        except Forbidden:
+            TELEGRAM_MESSAGES.inc('blocked')
+            stats['blocked'].append(chat_id)
+            return 'blocked'
+        except BadRequest as e:
+            # BadRequest - подкласс NetworkError, но повтор тут не поможет
+            if "chat not found" in str(e).lower():
+                TELEGRAM_MESSAGES.inc('blocked')
+                stats['blocked'].append(chat_id)
+                return 'blocked'
+            log.warning("⚠️ Ошибка отправки %s: %s", chat_id, e,
+                        extra={'sample': 'send_error', 'chat_id': chat_id})
+            break
+        except NetworkError as e:
+            # Таймауты и сетевые сбои - повторяем
+            if attempt == BROADCAST_MAX_RETRIES:
+                log.warning("⚠️ Ошибка отправки %s: %s", chat_id, e,
+                            extra={'sample': 'send_error', 'chat_id': chat_id})
+                break
+            await asyncio.sleep(1 + attempt)
+        except TelegramError as e:
+            log.warning("⚠️ Ошибка отправки %s: %s", chat_id, e,
+                        extra={'sample': 'send_error', 'chat_id': chat_id})
+            break
+    TELEGRAM_MESSAGES.inc('failed')
+    stats['failed'] += 1
+    return 'failed'
+
+
+async def run_broadcast(bot, chat_ids, send_kwargs, on_progress=None, on_done=None,
+                        concurrency=BROADCAST_CONCURRENCY):
+    """Рассылает одно сообщение списку чатов несколькими параллельными отправителями.
+
+    send_kwargs передаются в bot.send_message. on_progress(stats, total) -
+    необязательная корутина, которую вызывают раз в BROADCAST_PROGRESS_INTERVAL
+    секунд и в конце рассылки. on_done(chat_id, outcome) вызывается после
+    каждого получателя. Возвращает статистику с ключами sent, failed,
+    blocked (список chat_id), retry_after и elapsed.
+    """
+    chat_ids = list(chat_ids)
+    total = len(chat_ids)
+    stats = {'sent': 0, 'failed': 0, 'blocked': [], 'retry_after': 0, 'elapsed': 0.0}
+    started = time.monotonic()
+    pending = iter(chat_ids)
+
+    async def sender():
+        for chat_id in pending:
+            # При остановке не берем новых получателей - задание продолжится после запуска
+            if shutdown_flag:
+                break
+            outcome = await _send_with_retry(bot, chat_id, send_kwargs, stats)
+            if on_done:
+                on_done(chat_id, outcome)
+
+    async def report():
+        stats['elapsed'] = time.monotonic() - started
+        try:
+            await on_progress(stats, total)
+        except Exception as e:
+            log.warning("⚠️ Ошибка отчета о прогрессе рассылки: %s", e)
+
+    async def reporter():
+        while True:
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+            await report()
+
+    progress_task = asyncio.create_task(reporter()) if on_progress else None
+    try:
+        await asyncio.gather(*(sender() for _ in range(min(concurrency, total))))
+    finally:
+        if progress_task:
+            progress_task.cancel()
+
+    stats['elapsed'] = time.monotonic() - started
+    if stats['sent'] and stats['elapsed'] > 0:
+        BROADCAST_RATE.set(round(stats['sent'] / stats['elapsed'], 2))
+    if on_progress:
+        await report()
+    return stats
+
+
+def format_broadcast_progress(stats, total):
+    """Строка прогресса рассылки: отправлено, ошибки и скорость"""
+    done = stats['sent'] + stats['failed'] + len(stats['blocked'])
+    rate = stats['sent'] / stats['elapsed'] if stats['elapsed'] else 0
+    return (
+        f"{done}/{total} (отправлено {stats['sent']}, ошибок {stats['failed']}, "
+        f"заблокировали {len(stats['blocked'])}, RetryAfter {stats['retry_after']}, {rate:.1f} сообщ./сек)"
+    )
+
+
+# =============================================================================
+# ОТПРАВКА УВЕДОМЛЕНИЙ (ОЧЕРЕДЬ РАССЫЛОК)
+# =============================================================================
+
+# Статусы получателей в broadcast_recipients
+RECIPIENT_PENDING = 0
+RECIPIENT_STATUS = {'sent': 1, 'failed': 2, 'blocked': 3}
+
+_broadcast_job_event = asyncio.Event()
+_broadcast_job_waiters = {}
+_broadcast_job_progress = {}
 
-        for game in epic_games:
-            await send_func(
-                format_game_message(game, 'free'),
-                parse_mode='HTML',
-                disable_web_page_preview=False
+
+def create_sender_bot():
+    """Экземпляр Bot с пулом соединений под параллельных отправителей"""
+    return Bot(
+        token=TELEGRAM_BOT_TOKEN,
+        base_url=TELEGRAM_API_URL,
+        request=HTTPXRequest(connection_pool_size=BROADCAST_CONCURRENCY + 4)
+    )
+
+
+def _insert_broadcast_job(db, kind, payload, recipients):
+    """Добавляет задание и его получателей в текущую транзакцию db"""
+    cursor = db.execute(
+        "INSERT INTO broadcast_jobs (kind, payload, created_at) VALUES (?, ?, ?)",
+        (kind, json.dumps(payload, ensure_ascii=False), time.time())
+    )
+    job_id = cursor.lastrowid
+    dead_chats = get_dead_chats()
+    db.executemany(
+        "INSERT OR IGNORE INTO broadcast_recipients (job_id, chat_id) VALUES (?, ?)",
+        [(job_id, chat_id) for chat_id in recipients if chat_id not in dead_chats]
+    )
+    return job_id
+
+
+def enqueue_broadcast_job(kind, payload, recipients, notified=None):
+    """Сохраняет рассылку как задание с отдельной строкой на каждого получателя.
+
+    notified=(platform, game_id, notified_at) записывается в notified_games той
+    же транзакцией, чтобы игра не потерялась и не ушла повторно после рестарта.
+    """
+    with DB_WRITE_SECONDS.time('enqueue'), get_db() as db:
+        job_id = _insert_broadcast_job(db, kind, payload, recipients)
+        if notified is not None:
+            db.execute(
+                "INSERT OR REPLACE INTO notified_games (platform, game_id, notified_at) VALUES (?, ?, ?)",
+                notified
             )
-            sent_count += 1
-            await asyncio.sleep(0.5)
-    else:
-        await send_func(
-            "ℹ️ В Epic Games Store сейчас нет бесплатных игр.",
-            parse_mode='HTML'
+
+    _broadcast_job_event.set()
+    return job_id
+
+
+def enqueue_game_notification(game_info, game_type, platform, game_key, notified_at, change='new', previous=None):
+    """Ставит в очередь уведомление об игре и отмечает ее как отправленную.
+
+    change и previous (прошлое состояние из DealStateStore) попадают в
+    заголовок сообщения для deepened и returned.
+    """
+    recipients = settings_repo.recipients_for(game_type)
+    job_id = enqueue_broadcast_job(
+        'game',
+        {'game': game_info, 'game_type': game_type, 'change': change, 'previous': previous},
+        recipients,
+        notified=(platform, str(game_key), notified_at)
+    )
+    log.info("📨 Рассылка #%s в очереди: %s (%s, %s), получателей: %s",
+             job_id, game_info['title'], game_type, change, len(recipients),
+             extra={'job_id': job_id, 'recipients': len(recipients)})
+    return job_id
+
+
+def add_digest_item(item):
+    """Сохраняет предложение, ждущее дайджеста, и возвращает его с item_id.
+
+    deal_state уже записал изменение, поэтому без этой строки предложение,
+    найденное за DIGEST_WINDOW до падения, после рестарта не ушло бы никогда.
+    """
+    with DB_WRITE_SECONDS.time('digest'), get_db() as db:
+        cursor = db.execute(
+            "INSERT INTO digest_items (payload, created_at) VALUES (?, ?)",
+            (json.dumps(item, ensure_ascii=False), time.time())
         )
+    return dict(item, item_id=cursor.lastrowid)
 
-    # Проверяем скидки Steam
-    await send_func("🔥 <b>Проверяю большие скидки в Steam...</b>", parse_mode='HTML')
-    discounts = check_steam_discounts()
-    print(f"🔍 Найдено скидок 80%+ в Steam: {len(discounts)}")
 
-    if discounts:
-        await send_func(
-            "🔥 <b>Огромные скидки в Steam (80%+):</b>",
-            parse_mode='HTML'
+def load_digest_items():
+    """Предложения, которые ждали дайджеста на момент остановки"""
+    return [
+        dict(json.loads(payload), item_id=item_id)
+        for item_id, payload in get_db().execute("SELECT item_id, payload FROM digest_items ORDER BY item_id")
+    ]
+
+
+def enqueue_digest(items):
+    """Ставит в очередь дайджест накопленных предложений.
+
+    items - словари с ключами game, game_type, change, previous и notified
+    (platform, game_id, notified_at). Подписчики делятся на группы по
+    notify_free/notify_discounts, и каждая группа получает одно сообщение
+    только с нужными ей типами. Все задания и отметки notified_games
+    пишутся одной транзакцией, в ней же удаляются строки digest_items.
+    """
+    free = settings_repo.recipients_for('free')
+    discounts = settings_repo.recipients_for('discount')
+    groups = (
+        (free - discounts, ('free',)),
+        (discounts - free, ('discount',)),
+        (free & discounts, ('free', 'discount'))
+    )
+
+    job_ids = []
+    with DB_WRITE_SECONDS.time('enqueue'), get_db() as db:
+        for recipients, game_types in groups:
+            selected = [
+                {key: item[key] for key in ('game', 'game_type', 'change', 'previous')}
+                for item in items if item['game_type'] in game_types
+            ]
+            if not recipients or not selected:
+                continue
+            for start in range(0, len(selected), DIGEST_MAX_ITEMS):
+                chunk = selected[start:start + DIGEST_MAX_ITEMS]
+                # Одно предложение уходит обычным сообщением об игре
+                if len(chunk) == 1:
+                    job_ids.append(_insert_broadcast_job(db, 'game', chunk[0], recipients))
+                else:
+                    job_ids.append(_insert_broadcast_job(db, 'digest', {'items': chunk}, recipients))
+                log.info("📨 Дайджест #%s в очереди: %s предложений, получателей: %s",
+                         job_ids[-1], len(chunk), len(recipients))
+        db.executemany(
+            "INSERT OR REPLACE INTO notified_games (platform, game_id, notified_at) VALUES (?, ?, ?)",
+            [(platform, str(game_key), notified_at) for platform, game_key, notified_at in
+             (item['notified'] for item in items)]
+        )
+        db.executemany(
+            "DELETE FROM digest_items WHERE item_id = ?",
+            [(item['item_id'],) for item in items if 'item_id' in item]
         )
 
-        for game in discounts[:5]:
-            await send_func(
-                format_game_message(game, 'discount'),
-                parse_mode='HTML',
-                disable_web_page_preview=False
-            )
-            sent_count += 1
-            await asyncio.sleep(0.5)
+    _broadcast_job_event.set()
+    return job_ids
+
+
+def enqueue_text_broadcast(text, parse_mode='HTML'):
+    """Ставит в очередь текстовую рассылку всем подписчикам"""
+    return enqueue_broadcast_job('text', {'text': text, 'parse_mode': parse_mode}, load_users()["users"])
+
+
+async def wait_broadcast_job(job_id, on_progress=None):
+    """Ждет завершения задания и возвращает итоги {'sent', 'failed', 'blocked'}"""
+    future = _broadcast_job_waiters.get(job_id)
+    if future is None:
+        future = asyncio.get_running_loop().create_future()
+        _broadcast_job_waiters[job_id] = future
+    # Обработчик мог закончить задание раньше, чем мы начали ждать
+    row = get_db().execute(
+        "SELECT status, sent, failed, blocked FROM broadcast_jobs WHERE job_id = ?", (job_id,)
+    ).fetchone()
+    if row is not None and row[0] == 'done':
+        _broadcast_job_waiters.pop(job_id, None)
+        return {'sent': row[1], 'failed': row[2], 'blocked': row[3]}
+    if on_progress:
+        _broadcast_job_progress[job_id] = on_progress
+    try:
+        return await future
+    finally:
+        _broadcast_job_waiters.pop(job_id, None)
+        _broadcast_job_progress.pop(job_id, None)
 
-    if found_any or discounts:
-        await send_func(
-            f"✅ <b>Готово!</b> Найдено предложений: {sent_count}\n\n"
-            f"📬 Я буду присылать новые раздачи автоматически!",
-            parse_mode='HTML'
+
+def _next_broadcast_job():
+    return get_db().execute(
+        "SELECT job_id, kind, payload FROM broadcast_jobs WHERE status != 'done' ORDER BY job_id LIMIT 1"
+    ).fetchone()
+
+
+def _broadcast_send_kwargs(kind, payload):
+    """Параметры send_message для задания"""
+    if kind == 'game':
+        return render_game_message(
+            payload['game'], payload['game_type'], change=payload.get('change'), previous=payload.get('previous')
         )
+    if kind == 'digest':
+        return {'text': format_digest_message(payload['items']), 'parse_mode': 'HTML', 'disable_web_page_preview': True}
+    return {'text': payload['text'], 'parse_mode': payload.get('parse_mode', 'HTML'), 'disable_web_page_preview': False}
+
+
+async def process_broadcast_job(bot, job_id, kind, payload):
+    """Выполняет (или продолжает после рестарта) одно задание рассылки"""
+    db = get_db()
+    with db:
+        db.execute("UPDATE broadcast_jobs SET status = 'running' WHERE job_id = ?", (job_id,))
+
+    dead_chats = get_dead_chats()
+    chat_ids = [row[0] for row in db.execute(
+        "SELECT chat_id FROM broadcast_recipients WHERE job_id = ? AND status = ?", (job_id, RECIPIENT_PENDING)
+    ) if row[0] not in dead_chats]
+    if kind == 'game':
+        title = payload['game']['title']
+    elif kind == 'digest':
+        title = f"дайджест из {len(payload['items'])} предложений"
     else:
-        await send_func(
-            f"😔 <b>К сожалению, сейчас нет активных раздач.</b>\n\n"
-            f"📬 Как только появится новая бесплатная игра, я сразу тебе напишу.",
-            parse_mode='HTML'
+        title = 'текстовая рассылка'
+    log.info("📨 Рассылка #%s: %s, осталось получателей: %s", job_id, title, len(chat_ids))
+
+    def mark_done(chat_id, outcome):
+        with DB_WRITE_SECONDS.time('recipient'), db:
+            db.execute(
+                "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND chat_id = ?",
+                (RECIPIENT_STATUS[outcome], job_id, chat_id)
+            )
+
+    async def report_progress(stats, total):
+        # Строка прогресса собирается, только если INFO вообще пишется
+        if log.isEnabledFor(logging.INFO):
+            log.info("📊 Рассылка #%s: %s", job_id, format_broadcast_progress(stats, total), extra={'job_id': job_id})
+        callback = _broadcast_job_progress.get(job_id)
+        if callback:
+            await callback(stats, total)
+
+    await run_broadcast(bot, chat_ids, _broadcast_send_kwargs(kind, payload),
+                        on_progress=report_progress, on_done=mark_done)
+    if shutdown_flag:
+        # Оставшиеся получатели остались pending в broadcast_recipients
+        log.info("⏸️ Рассылка #%s прервана остановкой бота и продолжится после запуска", job_id)
+        return None
+
+    counts = dict(db.execute(
+        "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = ? GROUP BY status", (job_id,)
+    ).fetchall())
+    blocked = [row[0] for row in db.execute(
+        "SELECT chat_id FROM broadcast_recipients WHERE job_id = ? AND status = ?",
+        (job_id, RECIPIENT_STATUS['blocked'])
+    )]
+    summary = {
+        'sent': counts.get(RECIPIENT_STATUS['sent'], 0),
+        'failed': counts.get(RECIPIENT_STATUS['failed'], 0),
+        'blocked': len(blocked)
+    }
+
+    with db:
+        db.execute(
+            "UPDATE broadcast_jobs SET status = 'done', finished_at = ?, sent = ?, failed = ?, blocked = ? "
+            "WHERE job_id = ?",
+            (time.time(), summary['sent'], summary['failed'], summary['blocked'], job_id)
         )
+        db.execute("DELETE FROM broadcast_recipients WHERE job_id = ?", (job_id,))
 
+    if blocked:
+        removed = remove_users(blocked, mark_dead=True)
+        log.info("🧹 Удалено %s пользователей, заблокировавших бота", removed)
 
-# =============================================================================
-# ОТПРАВКА УВЕДОМЛЕНИЙ
-# =============================================================================
+    log.info("✅ Рассылка #%s завершена: отправлено %s, ошибок %s: %s",
+             job_id, summary['sent'], summary['failed'], title)
 
-async def send_notification_to_all(bot, game_info, game_type='free'):
-    """Отправляет уведомление всем подписанным пользователям с учетом настроек"""
-    users = load_users()
-    message = format_game_message(game_info, game_type)
+    future = _broadcast_job_waiters.get(job_id)
+    if future is not None and not future.done():
+        future.set_result(summary)
+    return summary
 
-    success_count = 0
-    failed_users = []
 
-    print(f"\n📨 Отправляю уведомление о: {game_info['title']}")
-    print(f"   Тип: {game_type}")
-    print(f"   ID: {game_info['id']}")
-    print(f"   Пользователей: {len(users['users'])}")
+async def broadcast_worker():
+    """Задача 3: Выполняет задания рассылки по очереди, продолжая прерванные"""
+    bot = create_sender_bot()
+    log.info("📮 Запуск обработчика очереди рассылок...")
+
+    while not shutdown_flag:
+        try:
+            _broadcast_job_event.clear()
+            job = _next_broadcast_job()
+            if job is None:
+                try:
+                    await asyncio.wait_for(_broadcast_job_event.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            job_id, kind, payload = job
+            await process_broadcast_job(bot, job_id, kind, json.loads(payload))
+        except Exception as e:
+            log.exception("❌ Ошибка в обработчике рассылок: %s", e)
+            await asyncio.sleep(10)
+
+    # Не оставляем /broadcast ждать задание, которое завершится уже после рестарта
+    for future in _broadcast_job_waiters.values():
+        future.cancel()
 
-    for user_id in users["users"]:
-        if game_type == 'free' and not get_user_setting(user_id, "notify_free", True):
-            continue
-        if game_type == 'discount' and not get_user_setting(user_id, "notify_discounts", False):
-            continue
 
+# =============================================================================
+# ЛОКАЛЬНЫЙ HTTP-СЕРВЕР
+# =============================================================================
+
+HTTP_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error'
+}
+
+
+async def _read_http_request(reader):
+    """Читает HTTP/1.1-запрос: (method, path, headers, body)"""
+    request_line = await asyncio.wait_for(reader.readline(), HTTP_SERVER_TIMEOUT)
+    method, target, _ = request_line.decode('latin-1').split(' ', 2)
+
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), HTTP_SERVER_TIMEOUT)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length') or 0)
+    if length > HTTP_SERVER_MAX_BODY:
+        raise OverflowError(length)
+    body = await asyncio.wait_for(reader.readexactly(length), HTTP_SERVER_TIMEOUT) if length else b''
+    return method, target.split('?', 1)[0], headers, body
+
+
+async def _serve_http_connection(reader, writer, routes):
+    """Обрабатывает одно соединение: один запрос, один ответ, закрытие"""
+    try:
         try:
-            await bot.send_message(
-                chat_id=user_id,
-                text=message,
-                parse_mode='HTML',
-                disable_web_page_preview=False
-            )
-            success_count += 1
-            if success_count % 10 == 0:
-                print(f"   Отправлено {success_count}/{len(users['users'])}")
-            await asyncio.sleep(0.05)
-        except TelegramError as e:
-            print(f"⚠️ Ошибка отправки {user_id}: {e}")
-            if "Forbidden" in str(e) or "blocked" in str(e).lower():
-                failed_users.append(user_id)
+            method, path, headers, body = await _read_http_request(reader)
+        except OverflowError:
+            status, content_type, payload = 413, 'text/plain', b'payload too large'
+        except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            status, content_type, payload = 400, 'text/plain', b'bad request'
+        else:
+            handlers = routes.get(path)
+            if handlers is None:
+                status, content_type, payload = 404, 'text/plain', b'not found'
+            elif method not in handlers:
+                status, content_type, payload = 405, 'text/plain', b'method not allowed'
+            else:
+                try:
+                    status, content_type, payload = await handlers[method](headers, body)
+                except Exception as e:
+                    log.error("❌ Ошибка обработчика %s %s: %s", method, path, e)
+                    status, content_type, payload = 500, 'text/plain', b'internal error'
+
+        writer.write(
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + payload
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
 
-    if failed_users:
-        for user_id in failed_users:
-            remove_user(user_id)
-        print(f"🧹 Удалено {len(failed_users)} пользователей, заблокировавших бота")
 
-    print(f"✅ Уведомление отправлено {success_count}/{len(users['users'])} пользователям: {game_info['title']}")
+async def start_http_server(host, port, routes):
+    """Запускает минимальный асинхронный HTTP-сервер.
 
-    return success_count > 0
+    routes - {path: {method: handler}}, где handler(headers, body) - корутина,
+    возвращающая (status, content_type, payload_bytes). Возвращает asyncio.Server.
+    """
+    return await asyncio.start_server(
+        lambda reader, writer: _serve_http_connection(reader, writer, routes), host, port
+    )
 
 
 # =============================================================================
@@ -1058,15 +3557,30 @@ async def send_notification_to_all(bot, game_info, game_type='free'):
 # =============================================================================
 
 shutdown_flag = False
+_shutdown_event = asyncio.Event()
+
 
+def signal_handler():
+    """Обработчик SIGINT/SIGTERM: только поднимает флаг остановки.
 
-def signal_handler(sig, frame):
-    """Обработчик для корректного завершения бота"""
+    Задачи сами выходят из своих циклов, поэтому вебхук успевает дообработать
+    принятые обновления, а Application - дождаться фоновых задач пользователей.
+    """
     global shutdown_flag
-    print("\n\n⚠️  Бот остановлен пользователем")
-    print("🔄 Закрываю соединения...")
+    if not shutdown_flag:
+        log.warning("⚠️ Бот остановлен пользователем, закрываю соединения...")
     shutdown_flag = True
-    sys.exit(0)
+    _shutdown_event.set()
+
+
+def install_signal_handlers(loop):
+    """Подключает signal_handler к циклу событий"""
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, signal_handler)
+        except NotImplementedError:
+            # Windows: add_signal_handler недоступен, переносим вызов в цикл событий
+            signal.signal(sig, lambda signum, frame: loop.call_soon_threadsafe(signal_handler))
 
 
 # =============================================================================
@@ -1075,7 +3589,13 @@ def signal_handler(sig, frame):
 
 async def bot_listener():
     """Задача 1: Слушает команды пользователей"""
-    app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+        .build()
+    )
 
     # Добавляем обработчики команд
     app.add_handler(CommandHandler("start", cmd_start))
@@ -1085,6 +3605,7 @@ async def bot_listener():
     app.add_handler(CommandHandler("broadcast", cmd_broadcast))
     app.add_handler(CommandHandler("testparse", cmd_test_parsing))
     app.add_handler(CommandHandler("checksub", cmd_check_sub))  # Новая диагностическая команда
+    app.add_handler(CommandHandler("stats", cmd_stats))
 
     # Добавляем обработчик callback-запросов
     app.add_handler(CallbackQueryHandler(check_subscription_callback, pattern="^check_subscription$"))
@@ -1092,162 +3613,350 @@ async def bot_listener():
     await app.initialize()
     await app.start()
 
-    print("🎧 Бот слушает команды пользователей...")
-    print(f"👑 Админ ID: {YOUR_ADMIN_ID}")
-    print(f"📢 Основной канал: {MAIN_CHANNEL_ID}")
-    print("📋 Доступные команды: /start, /stop, /help, /myid, /broadcast, /testparse, /checksub\n")
+    log.info("🎧 Бот слушает команды пользователей (%s)... Админ ID: %s, основной канал: %s",
+             BOT_MODE, YOUR_ADMIN_ID, MAIN_CHANNEL_ID)
+    log.info("📋 Доступные команды: /start, /stop, /help, /myid, /broadcast, /testparse, /checksub, /stats")
 
-    await app.updater.start_polling()
+    try:
+        if BOT_MODE == 'webhook':
+            await serve_webhook(app)
+        else:
+            await app.updater.start_polling()
+            while not shutdown_flag:
+                await asyncio.sleep(1)
+    finally:
+        if app.updater.running:
+            await app.updater.stop()
+        await app.stop()
+        await app.shutdown()
+
+
+async def serve_webhook(app):
+    """Принимает обновления от Telegram на локальном HTTP-сервере.
+
+    Обновление кладется в app.update_queue и сразу подтверждается, а
+    обработку ведет Application (до UPDATE_CONCURRENCY одновременно). При
+    остановке сервер перестает принимать запросы и ждет, пока уже принятые
+    обновления будут обработаны.
+    """
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_URL")
+    if not WEBHOOK_SECRET:
+        log.warning("⚠️ WEBHOOK_SECRET не задан: вебхук примет запрос от кого угодно")
+
+    async def handle_update(headers, body):
+        if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+            return 403, 'text/plain', b'forbidden'
+        try:
+            update = Update.de_json(json.loads(body), app.bot)
+        except (ValueError, TypeError, KeyError):
+            return 400, 'text/plain', b'bad update'
+        await app.update_queue.put(update)
+        return 200, 'text/plain', b'ok'
+
+    path = urlparse(WEBHOOK_URL).path or '/'
+    server = await start_http_server(WEBHOOK_LISTEN, WEBHOOK_PORT, {path: {'POST': handle_update}})
+    await app.bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or None,
+        max_connections=WEBHOOK_MAX_CONNECTIONS,
+        allowed_updates=Update.ALL_TYPES
+    )
+    log.info("🌐 Вебхук: %s -> %s:%s%s", WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, path)
 
     try:
         while not shutdown_flag:
             await asyncio.sleep(1)
     finally:
-        await app.updater.stop()
-        await app.stop()
-        await app.shutdown()
+        server.close()
+        await server.wait_closed()
+        # Дожидаемся обработки уже принятых обновлений
+        try:
+            await asyncio.wait_for(app.update_queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            log.warning("⚠️ Не все обновления обработаны за %s сек", WEBHOOK_DRAIN_TIMEOUT)
 
 
-async def games_checker():
-    """Задача 2: Периодически проверяет бесплатные игры"""
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
+async def sleep_unless_shutdown(seconds):
+    """Спит seconds секунд, но просыпается сразу при остановке бота"""
+    try:
+        await asyncio.wait_for(_shutdown_event.wait(), timeout=max(seconds, 0))
+    except asyncio.TimeoutError:
+        pass
 
-    await asyncio.sleep(5)
-    print("🔍 Запуск проверщика игр...\n")
 
-    notified_games = load_notified_games()
-    print(f"📂 Загружено: {len(notified_games.get('steam', {}))} Steam, {len(notified_games.get('epic', {}))} Epic")
+def dedup_and_enqueue(source, games, notified_games, processed_feeds, digest=None):
+    """Сверяет результаты источника с notified_games и ставит новые игры в очередь рассылки.
+
+    Если передан список digest, игры не рассылаются сразу, а копятся в нем
+    для enqueue_digest.
+    """
+    # Если лента не менялась, сверять нечего
+    if source.feed:
+        feed_version = get_feed_version(source.feed)
+        if feed_version is not None and processed_feeds.get(source.feed) == feed_version:
+            log.info("⏭️ Лента %s не изменилась", source.title)
+            return
+
+    # В рассылку идут только изменения: новые, подешевевшие и вернувшиеся
+    # предложения. notified_games защищает от повтора только новых
+    present_ids = None
+    if source.announce_limit is not None:
+        present_ids = {str(source.dedup_key(game)) for game in games}
+        games = games[:source.announce_limit]
+    for kind, game_id, game, previous in deal_states.diff(source, games, present_ids):
+        if kind == 'ended':
+            log.debug("⌛ %s: предложение %s закончилось", source.title, game_id)
+            continue
+        if kind == 'new' and notified_games.contains(source.namespace, game_id):
+            log.debug("⏭️ %s уже была отправлена", game['title'])
+            continue
+
+        log.info("🆕 %s (%s): %s", source.title, kind, game['title'])
+        notified_at = time.time()
+        if digest is not None:
+            digest.append(add_digest_item({
+                'game': game,
+                'game_type': source.game_type,
+                'change': kind,
+                'previous': previous,
+                'notified': (source.namespace, game_id, notified_at)
+            }))
+        else:
+            enqueue_game_notification(
+                game, source.game_type, source.namespace, game_id, notified_at, change=kind, previous=previous
+            )
+        notified_games.mark(source.namespace, game_id, notified_at)
 
-    notified_games = clean_old_games(notified_games, days=7)
-    save_notified_games(notified_games)
+    if source.feed:
+        processed_feeds[source.feed] = feed_version
 
+
+async def run_source_schedule(source, queue):
+    """Опрашивает один источник по его собственному расписанию.
+
+    Результат кладется в queue как (source, games, elapsed); при ошибке
+    games равен None, а следующая попытка откладывается с backoff.
+    """
     while not shutdown_flag:
+        started = time.monotonic()
         try:
-            print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Проверяю предложения...")
-
-            # Проверка Steam (бесплатные)
-            print("🔍 Проверяю Steam (бесплатные)...")
-            steam_free = check_steam_free_games()
-            print(f"   Найдено: {len(steam_free)}")
-
-            for game in steam_free:
-                if game['id'] not in notified_games['steam']:
-                    print(f"🆕 Новая бесплатная игра в Steam: {game['title']}")
-                    if await send_notification_to_all(bot, game, 'free'):
-                        notified_games['steam'][game['id']] = time.time()
-                        print(f"💾 Сохраняю ID {game['id']} в notified_games")
-                        save_notified_games(notified_games)
-                    else:
-                        print(f"⚠️ Не удалось отправить уведомление для {game['title']}")
-                else:
-                    print(f"⏭️ Игра {game['title']} уже была отправлена")
-
-            # Проверка Epic Games
-            print("\n🔍 Проверяю Epic Games...")
-            epic_games = check_epic_free_games()
-            print(f"   Найдено: {len(epic_games)}")
-
-            for game in epic_games:
-                if game['id'] not in notified_games['epic']:
-                    print(f"🆕 Новая бесплатная игра в Epic: {game['title']}")
-                    if await send_notification_to_all(bot, game, 'free'):
-                        notified_games['epic'][game['id']] = time.time()
-                        print(f"💾 Сохраняю ID {game['id']} в notified_games")
-                        save_notified_games(notified_games)
-                    else:
-                        print(f"⚠️ Не удалось отправить уведомление для {game['title']}")
-                else:
-                    print(f"⏭️ Игра {game['title']} уже была отправлена")
-
-            # Проверка больших скидок
-            print("\n🔍 Проверяю большие скидки в Steam...")
-            discounts = check_steam_discounts()
-            print(f"   Найдено: {len(discounts)}")
-
-            for game in discounts:
-                game_id = f"discount_{game['id']}"
-                if game_id not in notified_games['steam']:
-                    print(f"🆕 Новая скидка {game['discount']}%: {game['title']}")
-                    if await send_notification_to_all(bot, game, 'discount'):
-                        notified_games['steam'][game_id] = time.time()
-                        print(f"💾 Сохраняю ID {game_id} в notified_games")
-                        save_notified_games(notified_games)
-                    else:
-                        print(f"⚠️ Не удалось отправить уведомление для {game['title']}")
-                else:
-                    print(f"⏭️ Скидка для {game['title']} уже была отправлена")
+            games = await source.fetch()
+            source.failures = 0
+            SOURCE_FETCHES.inc(source.name, 'ok')
+            SOURCE_GAMES.set(len(games), source.name)
+        except Exception as e:
+            games = None
+            source.failures += 1
+            SOURCE_FETCHES.inc(source.name, 'error')
+            log.error("❌ Ошибка источника %s (%s подряд): %s", source.name, source.failures, e,
+                      extra={'source': source.name})
 
-            # Очищаем старые игры
-            print("\n🧹 Очистка старых игр...")
-            before_clean = len(notified_games.get('steam', {})) + len(notified_games.get('epic', {}))
-            notified_games = clean_old_games(notified_games, days=7)
-            after_clean = len(notified_games.get('steam', {})) + len(notified_games.get('epic', {}))
-            print(f"   Было: {before_clean}, Стало: {after_clean}")
+        elapsed = time.monotonic() - started
+        SOURCE_FETCH_SECONDS.observe(elapsed, source.name)
+        await queue.put((source, games, elapsed))
+        delay = source.next_delay(games)
+        log.info("⏳ %s: следующая проверка через %.1f мин", source.name, delay / 60)
+        await sleep_unless_shutdown(delay)
 
-            save_notified_games(notified_games)
 
-            print(f"\n⏳ Следующая проверка через {CHECK_INTERVAL // 60} минут...\n")
+async def games_checker():
+    """Задача 2: Опрашивает источники по их расписаниям и рассылает новые игры.
 
-            for i in range(CHECK_INTERVAL // 10):
+    Каждый источник работает в своем цикле (run_source_schedule), а здесь
+    результаты по мере поступления проходят дедупликацию, уходят в очередь
+    рассылки и обновляют снимок для /start и /testparse.
+    """
+    await sleep_unless_shutdown(5)
+    log.info("🔍 Запуск проверщика игр...")
+
+    notified_games = load_notified_games()
+    notified_games.expire()
+
+    # Версии лент, которые уже сверены с notified_games
+    processed_feeds = {}
+
+    # Пока каждый источник не отчитался хотя бы раз, /start ждет первый круг
+    refresh = begin_deals_refresh()
+    waiting_first_round = set(STORE_SOURCES)
+
+    # Предложения, ждущие отправки дайджестом (None - дайджесты выключены).
+    # Оставшиеся с прошлого запуска уходят первыми; если дайджесты с тех пор
+    # выключили - сразу
+    pending_digest = load_digest_items()
+    if pending_digest and not DIGEST_MODE:
+        enqueue_digest(pending_digest)
+    digest = pending_digest if DIGEST_MODE else None
+    digest_deadline = None
+
+    queue = asyncio.Queue()
+    tasks = [asyncio.create_task(run_source_schedule(source, queue)) for source in STORE_SOURCES.values()]
+    next_cleanup = time.monotonic() + CHECK_INTERVAL
+
+    try:
+        while not shutdown_flag:
+            try:
+                try:
+                    source, games, elapsed = await asyncio.wait_for(queue.get(), timeout=10)
+                except asyncio.TimeoutError:
+                    source = None
+
+                if source is not None:
+                    log.info("📥 %s: найдено %s за %.1f сек", source.name, len(games or ()), elapsed,
+                             extra={'source': source.name, 'elapsed': round(elapsed, 3)})
+                    if games is not None:
+                        dedup_and_enqueue(source, games, notified_games, processed_feeds, digest)
+                        publish_deals({source.name: games})
+                    elif source.name not in deals_snapshot['deals']:
+                        publish_deals({source.name: ()})
+
+                    waiting_first_round.discard(source.name)
+                    if not waiting_first_round and refresh is not None and not refresh.done():
+                        refresh.set_result(deals_snapshot)
+
+                if digest and digest_deadline is None:
+                    digest_deadline = time.monotonic() + DIGEST_WINDOW
+                if digest and time.monotonic() >= digest_deadline:
+                    enqueue_digest(digest)
+                    digest.clear()
+                    digest_deadline = None
+
+                # Смотрит только вершину кучи, поэтому дешево на каждом шаге
+                notified_games.expire()
+
+                if time.monotonic() >= next_cleanup:
+                    next_cleanup = time.monotonic() + CHECK_INTERVAL
+
+                    pruned = deal_states.prune()
+                    if pruned:
+                        log.info("🧹 Забыто закончившихся предложений: %s", pruned)
+
+                    checkpoint_db()
+
+                    log.info("📦 Кэш appdetails: %s", appdetails_cache.format_stats())
+
+            except Exception as e:
+                log.exception("❌ Ошибка в проверщике игр: %s", e)
+                await asyncio.sleep(60)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if digest:
+            enqueue_digest(digest)
+        if refresh is not None and not refresh.done():
+            refresh.set_result(deals_snapshot)
+
+
+async def membership_revalidator():
+    """Задача 4: Перепроверяет подписку на канал у подписчиков рассылки.
+
+    Проверки идут пачками с собственным лимитом и берут токены из общего
+    бюджета Telegram, поэтому не мешают рассылкам и интерактивным проверкам.
+    Отписавшиеся от канала удаляются из рассылки; пользователи, для которых
+    Telegram не ответил, остаются.
+    """
+    await sleep_unless_shutdown(60)
+    bot = create_sender_bot()
+    limiter = AsyncTokenBucket(MEMBERSHIP_REVALIDATE_RATE, MEMBERSHIP_REVALIDATE_BATCH)
+    log.info("🔎 Запуск перепроверки подписок на канал...")
+
+    async def check(chat_id):
+        await limiter.acquire()
+        await telegram_rate_limiter.acquire()
+        return chat_id, await membership_cache.check(bot, chat_id, MAIN_CHANNEL_ID)
+
+    while not shutdown_flag:
+        try:
+            chat_ids = [chat_id for chat_id in load_users()["users"] if chat_id != YOUR_ADMIN_ID]
+            left_total = 0
+            for start in range(0, len(chat_ids), MEMBERSHIP_REVALIDATE_BATCH):
                 if shutdown_flag:
                     break
-                await asyncio.sleep(10)
-
+                batch = chat_ids[start:start + MEMBERSHIP_REVALIDATE_BATCH]
+                results = await asyncio.gather(*(check(chat_id) for chat_id in batch))
+                left = [chat_id for chat_id, is_member in results if is_member is False]
+                if left:
+                    left_total += remove_users(left)
+            log.info("🔎 Перепроверено подписок: %s, отписались от канала: %s", len(chat_ids), left_total)
         except Exception as e:
-            print(f"❌ Ошибка в проверщике игр: {e}")
-            import traceback
-            traceback.print_exc()
-            await asyncio.sleep(60)
+            log.exception("❌ Ошибка перепроверки подписок: %s", e)
+
+        await sleep_unless_shutdown(MEMBERSHIP_REVALIDATE_INTERVAL)
+
+
+async def metrics_server():
+    """Задача 5: Отдает метрики в формате Prometheus на /metrics"""
+    if not METRICS_PORT:
+        return
+
+    async def handle_metrics(headers, body):
+        return 200, 'text/plain; version=0.0.4; charset=utf-8', render_metrics().encode('utf-8')
+
+    try:
+        server = await start_http_server(METRICS_LISTEN, METRICS_PORT, {'/metrics': {'GET': handle_metrics}})
+    except OSError as e:
+        # Метрики необязательны - занятый порт не должен останавливать бота
+        log.error("❌ Не удалось запустить сервер метрик на %s:%s: %s", METRICS_LISTEN, METRICS_PORT, e)
+        return
+    log.info("📈 Метрики: http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+    try:
+        while not shutdown_flag:
+            await asyncio.sleep(1)
+    finally:
+        server.close()
+        await server.wait_closed()
 
 
 async def main():
     """Главная функция"""
     if TELEGRAM_BOT_TOKEN == "TU_TOKEN_DE_BOT":
-        print("❌ ОШИБКА: Настрой TELEGRAM_BOT_TOKEN")
+        log.error("❌ ОШИБКА: Настрой TELEGRAM_BOT_TOKEN")
         return
 
-    print("=" * 60)
-    print("🤖 БОТ БЕСПЛАТНЫХ ИГР - Запуск...")
-    print("=" * 60)
+    log.info("🤖 БОТ БЕСПЛАТНЫХ ИГР - Запуск...")
 
     # Проверка прав на запись
-    test_file = os.path.join(os.path.dirname(USERS_FILE), "test_write.txt")
+    test_file = os.path.join(os.path.dirname(DB_FILE), "test_write.txt")
     try:
         with open(test_file, 'w', encoding='utf-8') as f:
             f.write("test")
         os.remove(test_file)
-        print("✅ Права на запись есть")
+        log.info("✅ Права на запись есть")
     except Exception as e:
-        print(f"❌ Нет прав на запись: {e}")
-        print(f"   Путь: {os.path.dirname(USERS_FILE)}")
+        log.error("❌ Нет прав на запись в %s: %s", os.path.dirname(DB_FILE), e)
+
+    migrate_json_storage()
+    # Журнал, оставшийся после сбоя, уже проигран при открытии - сжимаем его
+    checkpoint_db()
 
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
+    install_signal_handlers(asyncio.get_running_loop())
 
-    print(f"⏱️  Интервал проверки: {CHECK_INTERVAL // 60} минут")
-    print(f"📁 Файл пользователей: {USERS_FILE}")
-    print(f"📁 Файл настроек: {USER_SETTINGS_FILE}")
-    print(f"📁 Файл игр: {NOTIFIED_GAMES_FILE}")
-    print(f"📁 Файл ожидающих: {PENDING_USERS_FILE}\n")
-    print("💡 Нажми Ctrl+C для остановки бота\n")
+    log.info("⏱️  Интервал проверки: %s минут", CHECK_INTERVAL // 60)
+    log.info("📁 База данных: %s", DB_FILE)
+    log.info("💡 Нажми Ctrl+C для остановки бота")
 
     try:
         await asyncio.gather(
             bot_listener(),
-            games_checker()
+            games_checker(),
+            broadcast_worker(),
+            membership_revalidator(),
+            metrics_server()
         )
     except KeyboardInterrupt:
-        print("\n⚠️  Бот остановлен пользователем")
+        log.warning("⚠️ Бот остановлен пользователем")
     except Exception as e:
-        print(f"\n❌ Ошибка: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("❌ Ошибка: %s", e)
+    finally:
+        await close_http_client()
+        appdetails_cache.close()
+        close_db()
 
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n⚠️  Бот успешно остановлен")
+        log.warning("⚠️ Бот успешно остановлен")
     except Exception as e:
-        print(f"\n❌ Критическая ошибка: {e}")
+        log.error("❌ Критическая ошибка: %s", e)
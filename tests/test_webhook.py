@@ -0,0 +1,179 @@
+"""Вебхук против локального фейкового Bot API: ответы сервера и дообработка при остановке."""
+import asyncio
+import json
+import os
+import socket
+import sys
+import unittest
+from pathlib import Path
+
+os.environ.setdefault("BOT_TOKEN", "1:test")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from telegram.ext import Application, CommandHandler  # noqa: E402
+
+import STEAMbot  # noqa: E402
+
+SECRET = "s3cret"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def command_update(update_id, text, chat_id=7):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+        },
+    }
+
+
+async def raw_request(port, data):
+    """Отправляет сырые байты и возвращает код ответа"""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(data)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return int(status_line.split()[1])
+
+
+def post(path, body, headers=None):
+    head = f"POST {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(body)}\r\n"
+    for name, value in (headers or {}).items():
+        head += f"{name}: {value}\r\n"
+    return head.encode("latin-1") + b"\r\n" + body
+
+
+class FakeBotApi:
+    """Минимальный Bot API на start_http_server: запоминает вызванные методы"""
+
+    def __init__(self, token):
+        self.token = token
+        self.calls = []
+        self.port = free_port()
+        self.server = None
+
+    async def start(self):
+        def route(method):
+            async def handle(headers, body):
+                self.calls.append(method)
+                result = {
+                    "getMe": {"id": 1, "is_bot": True, "first_name": "bot", "username": "bot"},
+                    "setWebhook": True,
+                    "sendMessage": {"message_id": 1, "date": 0, "chat": {"id": 7, "type": "private"}, "text": "ok"},
+                }[method]
+                return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+            return {"POST": handle}
+
+        routes = {f"/bot{self.token}/{method}": route(method) for method in ("getMe", "setWebhook", "sendMessage")}
+        self.server = await STEAMbot.start_http_server("127.0.0.1", self.port, routes)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+class WebhookTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.api = FakeBotApi(os.environ["BOT_TOKEN"])
+        await self.api.start()
+
+        self.port = free_port()
+        self.patched = {
+            "WEBHOOK_URL": "https://example.com/hook",
+            "WEBHOOK_LISTEN": "127.0.0.1",
+            "WEBHOOK_PORT": self.port,
+            "WEBHOOK_SECRET": SECRET,
+            "WEBHOOK_DRAIN_TIMEOUT": 5,
+            "shutdown_flag": False,
+        }
+        self.saved = {name: getattr(STEAMbot, name) for name in self.patched}
+        for name, value in self.patched.items():
+            setattr(STEAMbot, name, value)
+
+        self.handled = []
+
+        async def ping(update, context):
+            await asyncio.sleep(0.3)
+            await update.message.reply_text("pong")
+            self.handled.append(update.update_id)
+
+        self.app = (
+            Application.builder()
+            .token(os.environ["BOT_TOKEN"])
+            .base_url(f"http://127.0.0.1:{self.api.port}/bot")
+            .concurrent_updates(8)
+            .updater(None)
+            .build()
+        )
+        self.app.add_handler(CommandHandler("ping", ping))
+        await self.app.initialize()
+        await self.app.start()
+
+        self.webhook = asyncio.create_task(STEAMbot.serve_webhook(self.app))
+        for _ in range(100):
+            if "setWebhook" in self.api.calls:
+                break
+            await asyncio.sleep(0.02)
+
+    async def asyncTearDown(self):
+        STEAMbot.shutdown_flag = True
+        await asyncio.wait_for(self.webhook, 10)
+        await self.app.stop()
+        await self.app.shutdown()
+        await self.api.stop()
+        for name, value in self.saved.items():
+            setattr(STEAMbot, name, value)
+
+    def update_body(self, update_id):
+        return json.dumps(command_update(update_id, "/ping")).encode()
+
+    async def test_rejects_wrong_secret(self):
+        status = await raw_request(self.port, post("/hook", self.update_body(1),
+                                                   {"X-Telegram-Bot-Api-Secret-Token": "wrong"}))
+        self.assertEqual(status, 403)
+
+    async def test_rejects_malformed_requests(self):
+        secret = {"X-Telegram-Bot-Api-Secret-Token": SECRET}
+        self.assertEqual(await raw_request(self.port, post("/hook", b"not json", secret)), 400)
+        self.assertEqual(await raw_request(
+            self.port, b"POST /hook HTTP/1.1\r\nContent-Length: abc\r\n\r\n"), 400)
+        self.assertEqual(await raw_request(
+            self.port, f"POST /hook HTTP/1.1\r\nContent-Length: {STEAMbot.HTTP_SERVER_MAX_BODY + 1}\r\n\r\n"
+            .encode()), 413)
+        self.assertEqual(await raw_request(self.port, b"GET /hook HTTP/1.1\r\n\r\n"), 405)
+        self.assertEqual(await raw_request(self.port, post("/other", b"{}", secret)), 404)
+
+    async def test_accepts_update_and_runs_handler(self):
+        status = await raw_request(self.port, post("/hook", self.update_body(5),
+                                                   {"X-Telegram-Bot-Api-Secret-Token": SECRET}))
+        self.assertEqual(status, 200)
+        for _ in range(100):
+            if self.handled:
+                break
+            await asyncio.sleep(0.02)
+        self.assertEqual(self.handled, [5])
+        self.assertIn("sendMessage", self.api.calls)
+
+    async def test_drains_accepted_updates_on_shutdown(self):
+        status = await raw_request(self.port, post("/hook", self.update_body(9),
+                                                   {"X-Telegram-Bot-Api-Secret-Token": SECRET}))
+        self.assertEqual(status, 200)
+        # Останавливаемся, пока обработчик еще спит
+        STEAMbot.shutdown_flag = True
+        await asyncio.wait_for(self.webhook, 10)
+        self.assertEqual(self.handled, [9])
+
+
+if __name__ == "__main__":
+    unittest.main()